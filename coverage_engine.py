@@ -0,0 +1,439 @@
+"""
+This script contains the coverage engine used by the optimization algorithms.
+The cells each bus passes through are encoded as packed bit vectors (rows of uint64 words indexed by grid cell),
+so the coverage of a subset of buses is a bitwise OR of their rows followed by a popcount.
+The same encoding is used for the time-aware coverage, where the bits are (cell, hour, day type) triples.
+"""
+
+import copy
+
+import numpy as np
+
+# Number of set bits for every possible byte, used to popcount the uint64 words through a uint8 view.
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Number of bits unpacked at once when summing the weights of the covered cells, bounds the temporary arrays
+MEASURE_BITS = 2 ** 22
+
+# Day types of the departures and hours of the day of the time-aware coverage
+DAYS = ('weekday', 'saturday', 'sunday')
+HOURS = 24
+
+
+def popcount(words):
+    """
+    Count the set bits of packed bit vectors.
+
+    Args:
+        words (numpy.ndarray): Array of uint64 words, the last axis being the words of a single bit vector.
+
+    Returns:
+        numpy.ndarray: The number of set bits of each bit vector (the last axis is reduced).
+    """
+
+    words = np.ascontiguousarray(words, dtype='<u8')
+    return POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def pack_rows(incidence):
+    """
+    Pack a boolean incidence matrix into bit vectors.
+
+    Args:
+        incidence (numpy.ndarray): Boolean matrix of shape (rows, cells).
+
+    Returns:
+        numpy.ndarray: The uint64 matrix of shape (rows, ceil(cells / 64)) where the cell j is the bit j % 64
+        of the word j // 64.
+    """
+
+    incidence = np.asarray(incidence, dtype=bool)
+    rows, cells = incidence.shape
+    words_amount = max(1, -(-cells // 64))
+
+    padded = np.zeros((rows, words_amount * 64), dtype=bool)
+    padded[:, :cells] = incidence
+
+    return np.packbits(padded, axis=1, bitorder='little').view('<u8')
+
+
+def unpack_rows(words, cells_amount):
+    """
+    Unpack bit vectors into a boolean incidence matrix, the inverse of pack_rows().
+
+    Args:
+        words (numpy.ndarray): The uint64 matrix of shape (rows, words).
+        cells_amount (int): The number of cells encoded in each row.
+
+    Returns:
+        numpy.ndarray: Boolean matrix of shape (rows, cells_amount).
+    """
+
+    words = np.ascontiguousarray(words, dtype='<u8')
+    bits = np.unpackbits(words.view(np.uint8), axis=-1, bitorder='little')
+
+    return bits[..., :cells_amount].astype(bool)
+
+
+def get_cell_hours_tensor(cell_hours, grid_cells, bus_ids, days=DAYS):
+    """
+    Build the dense tensor of the bus frequencies in each cell for every hour and day type.
+
+    Args:
+        cell_hours (dict): The dict that contains a list of (x_axis, y_axis, day, hour, count) for each bus id,
+        as returned by get_cell_hours() in data_api.py.
+        grid_cells (list): The list of all the cells (x_axis, y_axis) in the grid, as returned by get_grid_cells().
+        bus_ids (list): The bus ids, one for each slice of the tensor.
+        days (tuple, optional): The day types to include, the other ones are ignored. Defaults to DAYS.
+
+    Returns:
+        numpy.ndarray: The uint16 tensor of shape (buses, days, HOURS, cells) with the number of departures.
+    """
+
+    cell_index = {cell: index for index, cell in enumerate(grid_cells)}
+    day_index = {day: index for index, day in enumerate(days)}
+    tensor = np.zeros((len(bus_ids), len(days), HOURS, len(grid_cells)), dtype=np.uint16)
+
+    for row, bus_id in enumerate(bus_ids):
+        for x_axis, y_axis, day, hour, count in cell_hours.get(bus_id, []):
+            if day in day_index:
+                tensor[row, day_index[day], hour, cell_index[(x_axis, y_axis)]] = min(count, np.iinfo(np.uint16).max)
+
+    return tensor
+
+
+class Coverage:
+    """
+    The coverage of the grid by each bus, encoded as packed bit vectors.
+    The buses are referred to by their index in 'bus_ids' and the cells by their index in the grid
+    (or in the flattened cell-hours for the time-aware coverage).
+    When the cells have weights, every count is the sum of the weights of the covered cells instead. The weighted
+    count unpacks the bit vectors into one byte per cell, a few rows at a time (see MEASURE_BITS), and multiplies
+    them by the weights, so it is slower than the popcount of the unweighted one.
+
+    Args:
+        bus_ids (list): List of the bus ids, one for each row of the incidence matrix.
+        incidence (numpy.ndarray): Boolean matrix of shape (buses, cells) that is True where the bus passes
+        through the cell.
+        weights (numpy.ndarray, optional): The non-negative weight of each cell. Defaults to None (unweighted).
+    """
+
+    def __init__(self, bus_ids, incidence, weights=None):
+        incidence = np.asarray(incidence, dtype=bool)
+
+        if incidence.shape[0] != len(bus_ids):
+            raise Exception('The incidence matrix must have one row for each bus id!')
+
+        self.bus_ids = list(bus_ids)
+        self.bus_index = {bus_id: index for index, bus_id in enumerate(self.bus_ids)}
+        self.cells_amount = incidence.shape[1]
+        self.bitsets = pack_rows(incidence)
+        self.cells = [np.flatnonzero(row) for row in incidence]
+        self.set_weights(weights)
+
+    def set_weights(self, weights):
+        """
+        Set the weights of the cells, updating the total and the size of each bus accordingly.
+
+        Args:
+            weights (numpy.ndarray): The non-negative weight of each cell, None for the unweighted coverage.
+        """
+
+        if weights is None:
+            self.weights = None
+            self.total = self.cells_amount
+        else:
+            weights = np.asarray(weights, dtype=np.float64)
+            if weights.shape != (self.cells_amount,):
+                raise Exception('The weights must have one value for each cell!')
+            if (weights < 0).any():
+                raise Exception('The weights must be non-negative!')
+
+            self.weights = weights
+            self.total = float(weights.sum())
+
+        self.sizes = self.measure(self.bitsets)
+
+    def weighted(self, weights):
+        """
+        Get a copy of the coverage with the given cell weights, sharing the encoded buses.
+
+        Args:
+            weights (numpy.ndarray): The non-negative weight of each cell, None for the unweighted coverage.
+
+        Returns:
+            Coverage: The weighted coverage.
+        """
+
+        coverage = copy.copy(self)
+        coverage.set_weights(weights)
+
+        return coverage
+
+    @classmethod
+    def from_bitsets(cls, bus_ids, bitsets, cells_amount, weights=None):
+        """
+        Build the coverage from rows already packed with pack_rows(), for example loaded from a cache.
+
+        Args:
+            bus_ids (list): List of the bus ids, one for each row.
+            bitsets (numpy.ndarray): The uint64 matrix of shape (buses, words).
+            cells_amount (int): The number of cells encoded in each row.
+            weights (numpy.ndarray, optional): The non-negative weight of each cell. Defaults to None (unweighted).
+
+        Returns:
+            Coverage: The coverage of the grid by the buses.
+        """
+
+        return cls(bus_ids, unpack_rows(bitsets, cells_amount), weights)
+
+    @classmethod
+    def from_route_cells(cls, route_cells, grid_cells, bus_ids=None, weights=None):
+        """
+        Build the coverage from the output of get_route_cells() in data_api.py.
+
+        Args:
+            route_cells (dict): The dict that contains a list of cells (x_axis, y_axis) for each bus id.
+            grid_cells (list): The list of all the cells (x_axis, y_axis) in the grid, as returned by get_grid_cells().
+            bus_ids (list, optional): The bus ids to encode, buses without cells get an empty row.
+            Defaults to the keys of route_cells.
+            weights (list, optional): The weight of each cell in grid_cells. Defaults to None (unweighted).
+
+        Returns:
+            Coverage: The coverage of the grid by the buses.
+        """
+
+        if bus_ids is None:
+            bus_ids = list(route_cells.keys())
+
+        cell_index = {cell: index for index, cell in enumerate(grid_cells)}
+        incidence = np.zeros((len(bus_ids), len(grid_cells)), dtype=bool)
+
+        for row, bus_id in enumerate(bus_ids):
+            for cell in route_cells.get(bus_id, []):
+                incidence[row, cell_index[tuple(cell)]] = True
+
+        return cls(bus_ids, incidence, weights)
+
+    @classmethod
+    def from_csr(cls, csr, weights=None):
+        """
+        Build the coverage from the compressed sparse row incidence matrix returned by get_route_cells()
+        in data_api.py with output='csr'.
+
+        Args:
+            csr (dict): The dict with the 'bus_ids', 'shape', 'indptr' and 'indices' of the matrix.
+            weights (list, optional): The weight of each column of the matrix. Defaults to None (unweighted).
+
+        Returns:
+            Coverage: The coverage of the grid by the buses.
+        """
+
+        indptr = np.asarray(csr['indptr'])
+        incidence = np.zeros(csr['shape'], dtype=bool)
+        incidence[np.repeat(np.arange(len(indptr) - 1), np.diff(indptr)), csr['indices']] = True
+
+        return cls(csr['bus_ids'], incidence, weights)
+
+    @classmethod
+    def from_cell_hours(cls, cell_hours, grid_cells, bus_ids=None, days=DAYS, weights=None):
+        """
+        Build the coverage of the (cell, hour, day type) triples from the output of get_cell_hours() in data_api.py.
+        The triples are flattened day first, then hour, then cell, see get_cell_hours_tensor().
+
+        Args:
+            cell_hours (dict): The dict that contains a list of (x_axis, y_axis, day, hour, count) for each bus id.
+            grid_cells (list): The list of all the cells (x_axis, y_axis) in the grid, as returned by get_grid_cells().
+            bus_ids (list, optional): The bus ids to encode, buses without departures get an empty row.
+            Defaults to the keys of cell_hours.
+            days (tuple, optional): The day types to encode. Defaults to DAYS.
+            weights (list, optional): The weight of each cell in grid_cells, applied to every hour and day type.
+            Defaults to None (unweighted).
+
+        Returns:
+            Coverage: The coverage of the cell-hours by the buses.
+        """
+
+        if bus_ids is None:
+            bus_ids = list(cell_hours.keys())
+
+        tensor = get_cell_hours_tensor(cell_hours, grid_cells, bus_ids, days)
+
+        if weights is not None:
+            weights = np.tile(np.asarray(weights, dtype=np.float64), len(days) * HOURS)
+
+        return cls(bus_ids, tensor.reshape(len(bus_ids), -1) > 0, weights)
+
+    @property
+    def buses_amount(self):
+        return len(self.bus_ids)
+
+    def indices(self, bus_list):
+        """
+        Map bus ids to their row index, ignoring the bus ids that are not encoded.
+
+        Args:
+            bus_list (list): List of the bus ids.
+
+        Returns:
+            list: The row indices of the buses.
+        """
+
+        return [self.bus_index[bus_id] for bus_id in bus_list if bus_id in self.bus_index]
+
+    def measure(self, words):
+        """
+        Count the cells of packed bit vectors, or sum their weights when the coverage is weighted.
+
+        Args:
+            words (numpy.ndarray): Array of uint64 words, the last axis being the words of a single bit vector.
+
+        Returns:
+            numpy.ndarray: The count (or weight) of each bit vector (the last axis is reduced).
+        """
+
+        if self.weights is None:
+            return popcount(words)
+
+        # The bit vectors are unpacked a few rows at a time, then the covered cells are summed with a product
+        words = np.ascontiguousarray(words, dtype='<u8')
+        rows = words.reshape(-1, words.shape[-1])
+        sizes = np.empty(len(rows), dtype=np.float64)
+        chunk = max(1, MEASURE_BITS // max(1, rows.shape[1] * 64))
+
+        for start in range(0, len(rows), chunk):
+            bits = np.unpackbits(rows[start:start + chunk].view(np.uint8), axis=-1, bitorder='little')
+            sizes[start:start + chunk] = bits[:, :self.cells_amount] @ self.weights
+
+        return sizes.reshape(words.shape[:-1])[()]
+
+    def measure_cells(self, cells):
+        """
+        Count the given cells, or sum their weights when the coverage is weighted.
+
+        Args:
+            cells (numpy.ndarray): The cell indices.
+
+        Returns:
+            int or float: The count (or weight) of the cells.
+        """
+
+        if self.weights is None:
+            return len(cells)
+
+        return float(self.weights[cells].sum())
+
+    def union(self, indices):
+        """
+        Compute the bit vector of the cells covered by the given buses.
+
+        Args:
+            indices (list): The row indices of the buses.
+
+        Returns:
+            numpy.ndarray: The uint64 bit vector of the covered cells.
+        """
+
+        return np.bitwise_or.reduce(self.bitsets[list(indices)], axis=0)
+
+    def count(self, indices):
+        """
+        Count the cells covered by the given buses.
+
+        Args:
+            indices (list): The row indices of the buses.
+
+        Returns:
+            int or float: The number (or weight) of covered cells.
+        """
+
+        return self.measure(self.union(indices)).item()
+
+    def marginal(self, index, covered):
+        """
+        Count the cells covered by a bus that are not covered yet.
+
+        Args:
+            index (int): The row index of the bus.
+            covered (numpy.ndarray): The uint64 bit vector of the cells covered so far.
+
+        Returns:
+            int or float: The number (or weight) of newly covered cells.
+        """
+
+        return self.measure(self.bitsets[index] & ~covered).item()
+
+    def marginals(self, indices, covered):
+        """
+        Count the cells not covered yet for several buses at once.
+
+        Args:
+            indices (numpy.ndarray): The row indices of the buses.
+            covered (numpy.ndarray): The uint64 bit vector of the cells covered so far.
+
+        Returns:
+            numpy.ndarray: The number (or weight) of newly covered cells for each bus.
+        """
+
+        return self.measure(self.bitsets[indices] & ~covered)
+
+    def dominated(self):
+        """
+        Find the buses whose cells are a subset of the cells of another bus.
+        When several buses cover exactly the same cells, all of them but the first are dominated.
+
+        Returns:
+            numpy.ndarray: The boolean mask of the dominated buses.
+        """
+
+        dominated = np.zeros(self.buses_amount, dtype=bool)
+
+        for index in range(self.buses_amount):
+            # Cells of the bus that are missed by each other bus
+            missed = popcount(self.bitsets[index] & ~self.bitsets)
+            supersets = np.flatnonzero(missed == 0)
+            for other in supersets:
+                if other == index:
+                    continue
+                if len(self.cells[other]) > len(self.cells[index]) or other < index:
+                    dominated[index] = True
+                    break
+
+        return dominated
+
+    def evaluate(self, subsets, batch_size=4096):
+        """
+        Count the cells covered by each subset of buses, evaluating them in batches.
+
+        Args:
+            subsets (numpy.ndarray): Integer matrix of shape (subsets, k) with the row indices of the buses.
+            batch_size (int, optional): The number of subsets evaluated at once. Defaults to 4096.
+
+        Returns:
+            numpy.ndarray: The number (or weight) of covered cells for each subset.
+        """
+
+        subsets = np.asarray(subsets, dtype=np.intp)
+        if subsets.ndim == 1:
+            subsets = subsets[np.newaxis, :]
+
+        counts = np.empty(len(subsets), dtype=np.int64 if self.weights is None else np.float64)
+        for start in range(0, len(subsets), batch_size):
+            batch = subsets[start:start + batch_size]
+            unions = np.bitwise_or.reduce(self.bitsets[batch], axis=1)
+            counts[start:start + batch_size] = self.measure(unions)
+
+        return counts
+
+    def coverage(self, bus_list):
+        """
+        Calculate the ratio of the grid covered by the given buses, weighted by the cells' weights if any.
+
+        Args:
+            bus_list (list): List of the bus ids.
+
+        Returns:
+            float: The covered ratio of the grid.
+        """
+
+        return self.count(self.indices(bus_list)) / self.total if self.total else 0.0
@@ -1,20 +1,488 @@
 """
 This script contains functions that retrieve data from the db in order to be further processed or displayed.
+The visualization libraries (folium, matplotlib, datetimerange) are imported only by the functions that use them,
+so importing this module stays fast for the optimization scripts and their worker processes.
 """
 
+import collections
+import contextlib
+import csv
 import datetime
+import functools
+import hashlib
+import inspect
+import io
+import itertools
 import json
+import os
+import pickle
 import sqlite3
+import threading
 from pathlib import Path
 
-import folium
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-from datetimerange import DateTimeRange
-from folium.plugins import TimestampedGeoJson
+import numpy as np
 
 db = Path.cwd() / 'data/main.db'
 
+# Size in pixels of the map tiles, used to convert a zoom level to a simplification tolerance
+TILE_SIZE = 256
+
+
+class ConnectionPool:
+    """
+    Pool of read-only connections to the db, shared by the threads of the process.
+    The connections are opened in URI mode=ro with query_only and tuned for reading (memory mapping, large page cache
+    and in-memory temporary tables). A connection is used by a single thread at a time, so they are opened with
+    check_same_thread disabled and handed over between threads by the pool.
+
+    Args:
+        path (Path): The path of the db.
+        max_size (int, optional): The maximum number of open connections. Defaults to 8.
+        timeout (float, optional): The maximum time in seconds to wait for a free connection. Defaults to None (no limit).
+    """
+
+    pragmas = (
+        'PRAGMA query_only = ON;',
+        'PRAGMA mmap_size = 268435456;',
+        'PRAGMA cache_size = -65536;',
+        'PRAGMA temp_store = MEMORY;'
+    )
+
+    def __init__(self, path, max_size=8, timeout=None):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle = []
+        self.open_count = 0
+        self.closed = False
+        self.hits = 0
+        self.waits = 0
+        self.condition = threading.Condition()
+        self.pid = os.getpid()
+
+    def open(self):
+        conn = sqlite3.connect(f'{Path(self.path).resolve().as_uri()}?mode=ro', uri=True, check_same_thread=False)
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+
+        return conn
+
+    def acquire(self):
+        """
+        Take a connection from the pool, opening a new one if none is idle and the pool is not full,
+        or else waiting for another thread to release one.
+
+        Returns:
+            sqlite3.Connection: The connection.
+        """
+
+        with self.condition:
+            if not self.idle and self.open_count >= self.max_size:
+                self.waits += 1
+                if not self.condition.wait_for(lambda: self.idle or self.open_count < self.max_size, self.timeout):
+                    raise Exception('Timed out waiting for a db connection!')
+
+            if self.idle:
+                self.hits += 1
+                return self.idle.pop()
+
+            self.open_count += 1
+
+        try:
+            return self.open()
+        except Exception:
+            with self.condition:
+                self.open_count -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, conn):
+        """
+        Give a connection back to the pool, or close it when the pool was closed while it was in use.
+
+        Args:
+            conn (sqlite3.Connection): The connection.
+        """
+
+        if conn.in_transaction:
+            conn.rollback()
+
+        with self.condition:
+            if self.closed:
+                conn.close()
+                self.open_count -= 1
+            else:
+                self.idle.append(conn)
+            self.condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """
+        Close the idle connections and mark the pool as closed, so the ones in use are closed when they are released.
+        """
+
+        with self.condition:
+            self.closed = True
+            for conn in self.idle:
+                conn.close()
+            self.open_count -= len(self.idle)
+            self.idle = []
+
+    def stats(self):
+        """
+        Get the usage statistics of the pool.
+
+        Returns:
+            dict: The number of requests served by an idle connection ('hits'), of requests that had to wait for a
+            connection ('waits'), of open connections ('open') and of idle connections ('idle').
+        """
+
+        with self.condition:
+            return {'hits': self.hits, 'waits': self.waits, 'open': self.open_count, 'idle': len(self.idle)}
+
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Get the connection pool of the db, creating it on first use, when 'db' points to another file
+    or in a forked process (the connections of the parent process must not be shared).
+
+    Returns:
+        ConnectionPool: The connection pool.
+    """
+
+    global pool
+
+    with pool_lock:
+        if pool is None or pool.path != db or pool.pid != os.getpid():
+            if pool is not None and pool.pid == os.getpid():
+                pool.close()
+            pool = ConnectionPool(db)
+
+        return pool
+
+
+def connection():
+    """
+    Borrow a read-only connection from the pool, to be used as a context manager.
+
+    Returns:
+        contextlib.AbstractContextManager: The context manager that yields the connection.
+    """
+
+    return get_pool().connection()
+
+
+def get_pool_stats():
+    """
+    Get the usage statistics of the connection pool, see ConnectionPool.stats().
+
+    Returns:
+        dict: The pool statistics.
+    """
+
+    return get_pool().stats()
+
+
+def get_db_version():
+    """
+    Get a key that changes whenever the db is modified, without opening it with SQLite.
+    It combines the size and modification time of the db file (and of its write-ahead log, if any)
+    with the file change counter stored in the SQLite header.
+
+    Returns:
+        str: The version key of the db.
+    """
+
+    stat = db.stat()
+    with open(db, 'rb') as f:
+        header = f.read(28)
+    counter = int.from_bytes(header[24:28], 'big') if len(header) == 28 else 0
+
+    version = f'{stat.st_size:x}-{stat.st_mtime_ns:x}-{counter:x}'
+
+    wal = db.with_name(db.name + '-wal')
+    if wal.exists():
+        wal_stat = wal.stat()
+        version += f'-{wal_stat.st_size:x}-{wal_stat.st_mtime_ns:x}'
+
+    return version
+
+
+class ResultCache:
+    """
+    Cache of the results of the queries, invalidated whenever the db changes (see get_db_version()).
+    The results are kept pickled, so every hit returns a new copy that the caller is free to modify.
+    The most recently used ones are kept in memory up to max_bytes of pickled data, and all of them are also written
+    to cache_dir when provided, so they are shared between processes and kept across sessions. The least recently
+    used files are removed when the directory grows over max_disk_bytes.
+
+    Args:
+        max_bytes (int, optional): The maximum size of the results kept in memory. Defaults to 64 MiB.
+        cache_dir (Path, optional): The directory of the results stored on disk. Defaults to None (memory only).
+        max_disk_bytes (int, optional): The maximum size of the results stored on disk. Defaults to 512 MiB.
+    """
+
+    def __init__(self, max_bytes=64 * 2 ** 20, cache_dir=None, max_disk_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.max_disk_bytes = max_disk_bytes
+        self.results = collections.OrderedDict()
+        self.results_bytes = 0
+        self.version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def check_version(self):
+        """
+        Drop the results computed on a previous version of the db, in memory and on disk.
+
+        Returns:
+            str: The current version of the db.
+        """
+
+        version = hashlib.sha256(f'{db.resolve()}:{get_db_version()}'.encode()).hexdigest()[:16]
+
+        with self.lock:
+            if version != self.version:
+                self.results.clear()
+                self.results_bytes = 0
+                self.version = version
+                if self.cache_dir is not None and self.cache_dir.exists():
+                    for stale in self.cache_dir.glob('results-*.pickle'):
+                        if not stale.name.startswith(f'results-{version}-'):
+                            with contextlib.suppress(FileNotFoundError):
+                                stale.unlink()
+
+        return version
+
+    def path(self, version, key):
+        return self.cache_dir / f'results-{version}-{hashlib.sha256(repr(key).encode()).hexdigest()}.pickle'
+
+    def get(self, key):
+        """
+        Look up a result, first in memory and then on disk.
+
+        Args:
+            key (tuple): The normalized arguments of the query.
+
+        Returns:
+            tuple: Whether the result was found and the result itself.
+        """
+
+        version = self.check_version()
+
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                self.hits += 1
+                return True, pickle.loads(self.results[key])
+
+        if self.cache_dir is not None:
+            path = self.path(version, key)
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                data = None
+
+            with contextlib.suppress(FileNotFoundError):
+                path.touch() # The files are pruned in order of last use, see prune()
+
+            if data is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                    self.store(key, data)
+                return True, pickle.loads(data)
+
+        with self.lock:
+            self.misses += 1
+
+        return False, None
+
+    def put(self, key, result):
+        """
+        Save a result in memory and on disk.
+
+        Args:
+            key (tuple): The normalized arguments of the query.
+            result (object): The result of the query, it must be picklable.
+        """
+
+        version = self.check_version()
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self.lock:
+            self.store(key, data)
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            path = self.path(version, key)
+            # Write to a temporary file first so that a concurrent reader never sees a partial result
+            temp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+            temp.write_bytes(data)
+            os.replace(temp, path)
+            self.prune()
+
+    def store(self, key, data):
+        if key in self.results:
+            self.results_bytes -= len(self.results.pop(key))
+        if len(data) > self.max_bytes: # Too large to be kept in memory, it is only stored on disk
+            return
+
+        self.results[key] = data
+        self.results_bytes += len(data)
+        while self.results_bytes > self.max_bytes:
+            self.results_bytes -= len(self.results.popitem(last=False)[1])
+
+    def prune(self):
+        """
+        Remove the least recently used results on disk until they fit in max_disk_bytes.
+        """
+
+        files = []
+        for path in self.cache_dir.glob('results-*.pickle'):
+            with contextlib.suppress(FileNotFoundError): # Removed by another process
+                stat = path.stat()
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        disk_bytes = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files, key=lambda file: file[0]):
+            if disk_bytes <= self.max_disk_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
+            disk_bytes -= size
+
+    def clear(self):
+        """
+        Drop all the results, in memory and on disk, and reset the counters.
+        """
+
+        with self.lock:
+            self.results.clear()
+            self.results_bytes = 0
+            self.version = None
+            self.hits = self.disk_hits = self.misses = 0
+            if self.cache_dir is not None and self.cache_dir.exists():
+                for path in self.cache_dir.glob('results-*.pickle'):
+                    with contextlib.suppress(FileNotFoundError):
+                        path.unlink()
+
+    def stats(self):
+        """
+        Get the usage statistics of the cache.
+
+        Returns:
+            dict: The number of results served from memory ('hits') and from disk ('disk_hits'), of results that had
+            to be computed ('misses'), of results in memory ('size') and their pickled size in bytes ('bytes').
+        """
+
+        with self.lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'size': len(self.results),
+                    'bytes': self.results_bytes}
+
+
+result_cache = ResultCache()
+
+
+def configure_result_cache(max_bytes=64 * 2 ** 20, cache_dir=None, max_disk_bytes=512 * 2 ** 20):
+    """
+    Replace the result cache of the queries with a new one with the given limits, see ResultCache.
+    The results on disk are kept, so a cache_dir used before is still served.
+
+    Args:
+        max_bytes (int, optional): The maximum size of the results kept in memory. Defaults to 64 MiB.
+        cache_dir (Path, optional): The directory of the results stored on disk. Defaults to None (memory only).
+        max_disk_bytes (int, optional): The maximum size of the results stored on disk. Defaults to 512 MiB.
+
+    Returns:
+        ResultCache: The new result cache.
+    """
+
+    global result_cache
+
+    result_cache = ResultCache(max_bytes, cache_dir, max_disk_bytes)
+
+    return result_cache
+
+
+def normalize_argument(name, value):
+    """
+    Normalize an argument of a cached query, so that equivalent calls share the same key.
+    The bus ids are sorted and deduplicated, since the queries do not depend on their order.
+
+    Args:
+        name (str): The name of the argument.
+        value (object): The value of the argument.
+
+    Returns:
+        object: The hashable normalized value.
+    """
+
+    if name == 'bus_ids':
+        return tuple(sorted(set(value)))
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize_argument(None, item) for item in value)
+
+    return value
+
+
+def cached(function):
+    """
+    Decorator that memoizes a query in result_cache, keyed on its normalized arguments (see normalize_argument()).
+    The GeoJsons are returned with the bus ids of the caller in their properties, like the uncached function.
+
+    Args:
+        function (callable): The query, whose results depend only on its arguments and on the db.
+
+    Returns:
+        callable: The cached query.
+    """
+
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        key = (function.__name__,) + tuple(
+            (name, normalize_argument(name, value)) for name, value in arguments.arguments.items()
+        )
+
+        found, result = result_cache.get(key)
+        if not found:
+            result = function(*args, **kwargs)
+            result_cache.put(key, result)
+        elif isinstance(result, dict) and 'bus_ids' in result.get('properties', {}):
+            result['properties']['bus_ids'] = arguments.arguments['bus_ids']
+
+        return result
+
+    return wrapper
+
+
+def get_cache_stats():
+    """
+    Get the usage statistics of the result cache, see ResultCache.stats().
+
+    Returns:
+        dict: The cache statistics.
+    """
+
+    return result_cache.stats()
+
 
 def get_all_bus_ids():
     """
@@ -24,82 +492,366 @@ def get_all_bus_ids():
         list: The list of bus ids.
     """
 
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
+    with connection() as conn:
+        cursor = conn.cursor()
 
-    stmt = 'SELECT id FROM buses;'
-    bus_ids = cursor.execute(stmt).fetchall()
+        stmt = 'SELECT id FROM buses;'
+        bus_ids = cursor.execute(stmt).fetchall()
 
-    cursor.close()
-    conn.close()
+        cursor.close()
 
     return [bus_id[0] for bus_id in bus_ids]
 
 
-def get_routes_geojson(bus_ids, flip_coordinates=True):
+def get_lod_level(cursor, zoom=None, tolerance=None):
+    """
+    Find the level of detail of the routes to serve for a map zoom level or a simplification tolerance.
+    The levels and their tolerances are precomputed by utils/simplify-routes.py.
+
+    Args:
+        cursor (sqlite3.Cursor): The cursor used for the query.
+        zoom (int, optional): The zoom level of the map, the tolerance is the size of a pixel of its tiles in degrees.
+        Defaults to None.
+        tolerance (float, optional): The maximum distance in degrees between the simplified and the full routes,
+        takes precedence over zoom. Defaults to None.
+
+    Returns:
+        int: The level with the largest tolerance not above the requested one, None for the full resolution.
+    """
+
+    if tolerance is None:
+        if zoom is None:
+            return None
+        tolerance = 360 / (TILE_SIZE * 2 ** zoom)
+
+    stmt = 'SELECT level FROM routes_lod_levels WHERE tolerance <= ? ORDER BY tolerance DESC LIMIT 1;'
+    level = cursor.execute(stmt, (tolerance,)).fetchone()
+
+    return level[0] if level is not None else None
+
+
+def iter_routes_features(bus_ids, flip_coordinates=True, zoom=None, tolerance=None):
+    """
+    Generate the features of the routes GeoJson for the provided bus ids one at a time,
+    so that only the route of a single bus is kept in memory.
+    When a zoom level or a tolerance is provided, the routes simplified for that level of detail are served instead
+    of the full resolution ones, see get_lod_level().
+
+    Args:
+        bus_ids (list): List of the bus ids.
+        flip_coordinates (bool, optional): Flip the coordinates to comply with GeoJson. Defaults to True.
+        zoom (int, optional): The zoom level of the map. Defaults to None.
+        tolerance (float, optional): The simplification tolerance in degrees. Defaults to None (full resolution).
+
+    Yields:
+        dict: The feature of each bus route.
+    """
+
+    with connection() as conn:
+        cursor = conn.cursor()
+
+        level = get_lod_level(cursor, zoom, tolerance)
+        if level is None:
+            points_table, level_filter, params = 'routes_points', '', list(bus_ids)
+        else:
+            points_table, level_filter, params = 'routes_points_lod', 'AND rp.level = ?', [level, *bus_ids]
+
+        # Single ordered scan of the points of all the buses, buses without points get a single row with NULLs
+        stmt = f"""SELECT b.id, b.name, b.from_station_name, b.to_station_name, rp.segment, rp.lat, rp.lon
+            FROM buses b LEFT JOIN {points_table} rp ON rp.bus_id = b.id {level_filter}
+            WHERE b.id IN ({','.join(['?'] * len(bus_ids))}) ORDER BY b.id, rp.segment, rp.seq;"""
+        rows = cursor.execute(stmt, params)
+
+        for (bus_id, name, from_station, to_station), bus_rows in itertools.groupby(rows, key=lambda row: row[:4]):
+            coordinates_list = []
+            for segment, segment_rows in itertools.groupby(bus_rows, key=lambda row: row[4]):
+                if segment is None:
+                    continue
+                coordinates_list.append([
+                    [row[6], row[5]] if flip_coordinates else [row[5], row[6]] for row in segment_rows
+                ])
+
+            yield {
+                "type": "Feature",
+                "properties": {
+                    "bus_id": bus_id,
+                    "name": name,
+                    "from": from_station,
+                    "to": to_station
+                },
+                "geometry": {
+                    "type": "MultiLineString",
+                    "coordinates": coordinates_list,
+                }
+            }
+
+        cursor.close()
+
+
+@cached
+def get_routes_geojson(bus_ids, flip_coordinates=True, zoom=None, tolerance=None):
     """
     Generate the routes GeoJson for the provided bus ids.
-    This can be used to overlay it on top of a map in the jupyter notebooks.
+    This can be used to overlay it on top of a map in the jupyter notebooks, zoomed out maps should provide
+    their zoom level to get simplified routes with a fraction of the points (see iter_routes_features()).
 
     Args:
         bus_ids (list): List of the bus ids.
         flip_coordinates (bool, optional): Flip the coordinates to comply with GeoJson. Defaults to True.
+        zoom (int, optional): The zoom level of the map. Defaults to None.
+        tolerance (float, optional): The simplification tolerance in degrees. Defaults to None (full resolution).
 
     Returns:
         dict: The dict that represents the GeoJson.
     """
 
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
     geo_json = {
         "type": "FeatureCollection",
         "properties": {
             "bus_ids": bus_ids
         },
-        "features": []
+        "features": list(iter_routes_features(bus_ids, flip_coordinates, zoom, tolerance))
     }
 
-    stmt = f"""SELECT id, name, from_station_name, to_station_name FROM buses 
-        WHERE id IN ({','.join(['?'] * len(bus_ids))});"""
-    buses = cursor.execute(stmt, bus_ids).fetchall()
-
-    for bus_id, name, from_station, to_station in buses:
-        stmt = 'SELECT DISTINCT segment FROM routes_points WHERE bus_id = ? ORDER BY segment;'
-        segments = cursor.execute(stmt, [bus_id]).fetchall()
-        coordinates_list = []
-        for segment in segments:
-            stmt_sub = 'SELECT coordinates FROM routes_points WHERE bus_id = ? AND segment = ? ORDER BY segment, seq;'
-            coordinates = cursor.execute(stmt_sub, (bus_id, segment[0])).fetchall()
-            coordinates_list.append(
-                [list(map(float, row[0].split(',')[::-1] if flip_coordinates else row[0].split(','))) for row in coordinates]
-            )
-
-        route = {
-            "type": "Feature",
-            "properties": {
-                "bus_id": bus_id,
-                "name": name,
-                "from": from_station,
-                "to": to_station
-            },
-            "geometry": {
-                "type": "MultiLineString",
-                "coordinates": coordinates_list,
-            }
-        }
-        geo_json['features'].append(route)
+    return geo_json
 
-    cursor.close()
-    conn.close()
 
-    return geo_json
+def split_time_range(start, end):
+    """
+    Split a time range in the whole hours it contains and the partial hours at its ends.
+
+    Args:
+        start (str): The start of the range in format 'HH:MM'.
+        end (str): The end of the range in format 'HH:MM'.
+
+    Returns:
+        tuple: The first and last whole hours in format 'HH' (None if there are none) and
+        the list of partial ranges in format ('HH:MM', 'HH:MM').
+    """
+
+    first_hour = int(start[:2]) + (start[3:] != '00')
+    last_hour = int(end[:2]) - (end[3:] != '59')
+
+    if first_hour > last_hour:
+        return None, [(start, end)]
+
+    partial = []
+    if start[3:] != '00':
+        partial.append((start, f'{start[:2]}:59'))
+    if end[3:] != '59':
+        partial.append((f'{end[:2]}:00', end))
+
+    return (f'{first_hour:02d}', f'{last_hour:02d}'), partial
+
+
+def is_aggregated(cursor, stations_source):
+    """
+    Check whether the aggregate table 'cells_frequencies' is built for a stations source. It is emptied when the grid
+    or the departures change (see utils/generate-grid.py and utils/get-schedules.py) until utils/refresh-frequencies.py
+    rebuilds it.
+
+    Args:
+        cursor (sqlite3.Cursor): The cursor used for the query.
+        stations_source (str): The source of the stations' coordinates. Valid values: 'overpass', 'here'.
 
+    Returns:
+        bool: True if the aggregate can be read.
+    """
+
+    stmt = 'SELECT EXISTS (SELECT 1 FROM cells_frequencies WHERE stations_source = ?);'
+
+    return bool(cursor.execute(stmt, (stations_source,)).fetchone()[0])
+
+
+def get_buses_count(cursor, bus_ids, time_range, stations_source, level=0):
+    """
+    Count the departures in each cell for every hour of the time range.
+    The whole hours are read from the aggregate table 'cells_frequencies' (see utils/refresh-frequencies.py),
+    only the minutes of a partial first or last hour are counted from the table 'departures'.
+    When the aggregate is not built, the whole time range is counted from the table 'departures'.
+
+    Args:
+        cursor (sqlite3.Cursor): The cursor used for the queries.
+        bus_ids (list): List of the bus ids, None to count the departures of all the buses.
+        time_range (tuple): Time range in format ('saturday', '10:03', '11:03').
+        stations_source (str): The source of the stations' coordinates. Valid values: 'overpass', 'here'.
+        level (int, optional): The resolution level of the grid, 0 being the finest (see generate-grid.py).
+        Defaults to 0.
+
+    Returns:
+        dict: The dict that contains the count for each hour ('HH') for each cell id.
+    """
+
+    day, start, end = time_range
+    whole, partial = split_time_range(start, end)
+    if not is_aggregated(cursor, stations_source):
+        whole, partial = None, [(start, end)]
+    bus_filter = f"AND bus_id IN ({','.join(['?'] * len(bus_ids))})" if bus_ids is not None else ''
+    bus_params = bus_ids if bus_ids is not None else []
+
+    rows = []
+
+    if whole is not None:
+        stmt = f"""SELECT cell_id, hour, sum(count) FROM cells_frequencies
+            WHERE stations_source = ? AND day = ? {bus_filter} AND hour BETWEEN ? AND ? 
+            AND cell_id IN (SELECT id FROM grid_cells WHERE level = ?) GROUP BY cell_id, hour;"""
+        rows += cursor.execute(stmt, (stations_source, day, *bus_params, *whole, level)).fetchall()
+
+    for partial_start, partial_end in partial:
+        stmt = f"""SELECT cell_id, substr(time, 0, 3) AS interval, count(*) FROM departures d, stations_cells_{stations_source} sc 
+            WHERE d.station_id = sc.station_id AND sc.level = ? {bus_filter} AND day = ? AND time BETWEEN ? AND ? 
+            GROUP BY cell_id, interval;"""
+        rows += cursor.execute(stmt, (level, *bus_params, day, partial_start, partial_end)).fetchall()
+
+    buses_count = {}
+    for cell, interval, count in rows:
+        cell_count = buses_count.setdefault(cell, {})
+        cell_count[interval] = cell_count.get(interval, 0) + count
+
+    return buses_count
+
+
+@functools.lru_cache(maxsize=None)
+def get_colormap_table(name):
+    """
+    Get the hex colors of all the entries of a matplotlib colormap, so that the features are colored with a lookup
+    instead of a call to the colormap and a conversion for each one. matplotlib is imported on the first call only.
+
+    Args:
+        name (str): The name of the colormap, e.g. 'Reds'.
 
-def get_grid_geojson(bus_ids, time_range, flip_coordinates=True, stations_source='overpass'):
+    Returns:
+        tuple: The hex color of each entry of the colormap.
+    """
+
+    from matplotlib import cm, colors
+
+    colormap = cm.get_cmap(name)
+
+    return tuple(colors.to_hex(colormap(index)) for index in range(colormap.N))
+
+
+def iter_grid_features(bus_ids, time_range, flip_coordinates=True, stations_source='overpass', level=0):
+    """
+    Generate the features of the grid GeoJson one at a time, see get_grid_geojson().
+    The bus frequencies are aggregated when this function is called, so an invalid stations_source raises
+    right away, while the features are generated lazily cell by cell.
+
+    Args:
+        bus_ids (list): List of the bus ids.
+        time_range (tuple): Time range in format ('saturday', '10:03', '11:03').
+        flip_coordinates (bool, optional): Flip the coordinates. Defaults to True.
+        stations_source (str, optional): The source of the stations' coordinates.
+        Valid values: 'overpass', 'here'. Defaults to 'overpass'.
+        level (int, optional): The resolution level of the grid, 0 being the finest (see generate-grid.py).
+        Defaults to 0.
+
+    Returns:
+        generator: The generator of the feature of each cell for each hour in the time interval.
+    """
+
+    with connection() as conn:
+        cursor = conn.cursor()
+
+        if stations_source not in ('overpass', 'here'):
+            cursor.close()
+            raise Exception('Invalid stations_source!')
+
+        buses_count_subset = get_buses_count(cursor, bus_ids, time_range, stations_source, level)
+        buses_count_total = get_buses_count(cursor, None, time_range, stations_source, level)
+
+        cursor.close()
+
+    from datetimerange import DateTimeRange
+
+    tr = DateTimeRange(*time_range[-2:])
+    colors_table = get_colormap_table('Reds')
+
+    def features():
+        with connection() as conn:
+            cursor = conn.cursor()
+
+            stmt = 'SELECT id, x_axis, y_axis, lat_min, lon_min, lat_max, lon_max, corners FROM grid_cells WHERE level = ?;'
+
+            for cell_id, x_axis, y_axis, lat_min, lon_min, lat_max, lon_max, corners in cursor.execute(stmt, (level,)):
+                if corners is not None:
+                    # The corners of the hexagons in clockwise order, see generate_hex_grid() in generate-grid.py
+                    coordinates_list = np.frombuffer(corners, dtype='<f8').reshape(-1, 2).tolist()
+                else:
+                    # Upper left, upper right, lower right and lower left corners
+                    coordinates_list = [[lat_max, lon_min], [lat_max, lon_max], [lat_min, lon_max], [lat_min, lon_min]]
+                if flip_coordinates:
+                    coordinates_list = [corner[::-1] for corner in coordinates_list]
+
+                for time in tr.range(datetime.timedelta(hours=1)):
+                    time_hours = time.strftime('%H')
+                    if cell_id in buses_count_subset and time_hours in buses_count_subset[cell_id]:
+                        subset = buses_count_subset[cell_id][time_hours]
+                    else:
+                        subset = 0
+
+                    if cell_id in buses_count_total and time_hours in buses_count_total[cell_id]:
+                        total = buses_count_total[cell_id][time_hours]
+                    else:
+                        total = 0
+
+                    perc = subset / total if total else 0
+                    # Same entry as the colormap called with perc * 1.5 (1.5 - to increase the shade)
+                    cell_color = colors_table[min(int(perc * 1.5 * len(colors_table)), len(colors_table) - 1)]
+                    perc = round(perc * 100, 2)
+
+                    yield {
+                        "type": "Feature",
+                        "properties": {
+                            "matrix_coordinates": f"({x_axis},{y_axis})",
+                            "buses_count_subset": subset,
+                            "buses_count_total": total,
+                            "popup": f'({x_axis}, {y_axis}) {subset}/{total} ({perc}%)',
+                            # "fillColor": cell_color,
+                            "style": {
+                                'fillColor': cell_color,
+                                'color': 'black',
+                                'weight': 0.5,
+                                'dashArray': '5',
+                                'fillOpacity': 0.5
+                            },
+                            "time": "2020-10-10T" + time.strftime('%H:%M') + ":00"
+                        },
+                        "geometry": {
+                            "type": "Polygon",
+                            "coordinates": [coordinates_list]
+                        }
+                    }
+
+            cursor.close()
+
+    return features()
+
+
+def get_grid_properties(bus_ids, time_range):
+    """
+    Generate the properties of the grid GeoJson.
+
+    Args:
+        bus_ids (list): List of the bus ids.
+        time_range (tuple): Time range in format ('saturday', '10:03', '11:03').
+
+    Returns:
+        dict: The properties of the FeatureCollection.
+    """
+
+    return {
+        "time_range": f"{time_range[0]}: {time_range[1]} - {time_range[2]}",
+        "bus_ids": bus_ids
+    }
+
+
+@cached
+def get_grid_geojson(bus_ids, time_range, flip_coordinates=True, stations_source='overpass', level=0):
     """
     Generate the grid GeoJson based on the values saved in 'grid_cells' table.
     This can be used to overlay it on top of the routes in the jupyter notebooks.
+    The cells are rectangles, or hexagons when the grid was generated by generate_hex_grid() in generate-grid.py.
     For each hour in the time interval it will generate a grid.
     It also maps the bus stations to each cell in order to provide 'buses_count_subset' and
     'buses_count_total' in the returned GeoJson, that are the frequency of buses (counted at a single station)
@@ -112,148 +864,327 @@ def get_grid_geojson(bus_ids, time_range, flip_coordinates=True, stations_source
         flip_coordinates (bool, optional): Flip the coordinates. Defaults to True.
         stations_source (str, optional): The source of the stations' coordinates. 
         Valid values: 'overpass', 'here'. Defaults to 'overpass'.
+        level (int, optional): The resolution level of the grid, 0 being the finest (see generate-grid.py).
+        Defaults to 0.
 
     Returns:
         dict: The dict that represents the GeoJson.
     """
 
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
+    geo_json = {
+        "type": "FeatureCollection",
+        "properties": get_grid_properties(bus_ids, time_range),
+        "features": list(iter_grid_features(bus_ids, time_range, flip_coordinates, stations_source, level))
+    }
 
-    if stations_source == 'overpass':
-        stmt_buses_subset = f"""SELECT cell_id, substr(time, 0, 3) AS interval, count(*) FROM departures d, stations_cells_overpass sc 
-            WHERE d.station_id = sc.station_id AND bus_id IN ({','.join(['?'] * len(bus_ids))}) AND day = ? AND time BETWEEN ? AND ? 
-            GROUP BY cell_id, interval;"""
+    return geo_json
 
-        stmt_buses_all = f"""SELECT cell_id, substr(time, 0, 3) as interval, count(*) FROM departures d, stations_cells_overpass sc 
-            WHERE d.station_id = sc.station_id AND day = ? AND time BETWEEN ? AND ? GROUP BY cell_id, interval;"""
 
-    elif stations_source == 'here':
-        stmt_buses_subset = f"""SELECT cell_id, substr(time, 0, 3) as interval, count(*) FROM departures d, stations_cells_here sc 
-            WHERE d.station_id = sc.station_id AND bus_id IN ({','.join(['?'] * len(bus_ids))}) AND day = ? AND time BETWEEN ? AND ? 
-            GROUP BY cell_id, interval;"""
+def write_feature_collection(stream, features, properties=None, chunk_size=65536):
+    """
+    Write a GeoJson FeatureCollection to a file or a socket, serializing the features one at a time
+    and flushing them in chunks, so the memory used does not depend on the number of features.
 
-        stmt_buses_all = f"""SELECT cell_id, substr(time, 0, 3) as interval, count(*) FROM departures d, stations_cells_here sc 
-            WHERE d.station_id = sc.station_id AND day = ? AND time BETWEEN ? AND ? GROUP BY cell_id, interval;"""
+    Args:
+        stream (file or socket): The text or binary file, or the socket, to write to.
+        features (iterable): The features, for example from iter_routes_features() or iter_grid_features().
+        properties (dict, optional): The properties of the FeatureCollection. Defaults to None.
+        chunk_size (int, optional): The number of characters buffered before each write. Defaults to 65536.
 
-    else:
-        cursor.close()
-        conn.close()
-        raise Exception('Invalid stations_source!')
+    Returns:
+        int: The number of features written.
+    """
 
-    buses_count_subset = {}
-    for cell, interval, count in cursor.execute(stmt_buses_subset, (*bus_ids, *time_range)).fetchall():
-        d = {}
-        d[interval] = count
-        buses_count_subset.setdefault(cell, {}).update(d)
+    write = stream.sendall if hasattr(stream, 'sendall') else stream.write
+    binary = not isinstance(stream, io.TextIOBase)
 
-    buses_count_total = {}
-    for cell, interval, count in cursor.execute(stmt_buses_all, [*time_range]).fetchall():
-        d = {}
-        d[interval] = count
-        buses_count_total.setdefault(cell, {}).update(d)
+    def flush(chunks):
+        data = ''.join(chunks)
+        write(data.encode('utf-8') if binary else data)
 
-    geo_json = {
-        "type": "FeatureCollection",
-        "properties": {
-            "time_range": f"{time_range[0]}: {time_range[1]} - {time_range[2]}",
-            "bus_ids": bus_ids
-        },
-        "features": []
-    }
+    chunks = ['{"type": "FeatureCollection", ']
+    if properties is not None:
+        chunks.append(f'"properties": {json.dumps(properties)}, ')
+    chunks.append('"features": [')
+    buffered = sum(map(len, chunks))
 
-    tr = DateTimeRange(*time_range[-2:])
+    count = 0
+    for feature in features:
+        chunk = (', ' if count else '') + json.dumps(feature)
+        chunks.append(chunk)
+        buffered += len(chunk)
+        count += 1
 
-    stmt = 'SELECT id, x_axis, y_axis, upper_left, upper_right, lower_right, lower_left FROM grid_cells;'
+        if buffered >= chunk_size:
+            flush(chunks)
+            chunks = []
+            buffered = 0
 
-    for cell_id, x_axis, y_axis, u_left, u_right, l_right, l_left in cursor.execute(stmt).fetchall():
-        coordinates_list = [
-            list(map(float, u_left.split(',')[::-1] if flip_coordinates else u_left.split(','))),
-            list(map(float, u_right.split(',')[::-1] if flip_coordinates else u_right.split(','))),
-            list(map(float, l_right.split(',')[::-1] if flip_coordinates else l_right.split(','))),
-            list(map(float, l_left.split(',')[::-1] if flip_coordinates else l_left.split(',')))
-        ]
+    chunks.append(']}')
+    flush(chunks)
 
-        for time in tr.range(datetime.timedelta(hours=1)):
-            time_hours = time.strftime('%H')
-            if cell_id in buses_count_subset and time_hours in buses_count_subset[cell_id]:
-                subset = buses_count_subset[cell_id][time_hours]
-            else:
-                subset = 0
+    return count
 
-            if cell_id in buses_count_total and time_hours in buses_count_total[cell_id]:
-                total = buses_count_total[cell_id][time_hours]
-            else:
-                total = 0
 
-            perc = subset / total if total else 0
-            cell_color = plt.cm.get_cmap('Reds')(perc * 1.5)  # 5 - to increase the shade
-            cell_color = mpl.colors.to_hex(cell_color)
-            perc = round(perc * 100, 2)
+def write_routes_geojson(stream, bus_ids, flip_coordinates=True, zoom=None, tolerance=None):
+    """
+    Stream the routes GeoJson to a file or a socket, see get_routes_geojson() and write_feature_collection().
 
-            cell = {
-                "type": "Feature",
-                "properties": {
-                    "matrix_coordinates": f"({x_axis},{y_axis})",
-                    "buses_count_subset": subset,
-                    "buses_count_total": total,
-                    "popup": f'({x_axis}, {y_axis}) {subset}/{total} ({perc}%)',
-                    # "fillColor": cell_color,
-                    "style": {
-                        'fillColor': cell_color,
-                        'color': 'black',
-                        'weight': 0.5,
-                        'dashArray': '5',
-                        'fillOpacity': 0.5
-                    },
-                    "time": "2020-10-10T" + time.strftime('%H:%M') + ":00"
-                },
-                "geometry": {
-                    "type": "Polygon",
-                    "coordinates": [coordinates_list]
-                }
-            }
-            geo_json['features'].append(cell)
+    Args:
+        stream (file or socket): The text or binary file, or the socket, to write to.
+        bus_ids (list): List of the bus ids.
+        flip_coordinates (bool, optional): Flip the coordinates to comply with GeoJson. Defaults to True.
+        zoom (int, optional): The zoom level of the map. Defaults to None.
+        tolerance (float, optional): The simplification tolerance in degrees. Defaults to None (full resolution).
 
-    cursor.close()
-    conn.close()
+    Returns:
+        int: The number of features written.
+    """
 
-    return geo_json
+    features = iter_routes_features(bus_ids, flip_coordinates, zoom, tolerance)
+
+    return write_feature_collection(stream, features, {"bus_ids": bus_ids})
 
 
-def get_route_cells(bus_ids):
+def write_grid_geojson(stream, bus_ids, time_range, flip_coordinates=True, stations_source='overpass', level=0):
+    """
+    Stream the grid GeoJson to a file or a socket, see get_grid_geojson() and write_feature_collection().
+
+    Args:
+        stream (file or socket): The text or binary file, or the socket, to write to.
+        bus_ids (list): List of the bus ids.
+        time_range (tuple): Time range in format ('saturday', '10:03', '11:03').
+        flip_coordinates (bool, optional): Flip the coordinates. Defaults to True.
+        stations_source (str, optional): The source of the stations' coordinates.
+        Valid values: 'overpass', 'here'. Defaults to 'overpass'.
+        level (int, optional): The resolution level of the grid, 0 being the finest (see generate-grid.py).
+        Defaults to 0.
+
+    Returns:
+        int: The number of features written.
+    """
+
+    features = iter_grid_features(bus_ids, time_range, flip_coordinates, stations_source, level)
+
+    return write_feature_collection(stream, features, get_grid_properties(bus_ids, time_range))
+
+
+@cached
+def get_route_cells(bus_ids, output='lists', level=0):
     """
     Get the list with all the cells in the grid that the buses pass through.
     The cells are in a tuple format where the first element is the x-axis and the second is the y-axis in the grid matrix.
     It can be used to calculate the covered area in the optimization algorithm by generating the grid matrix first.
+    The 'csr' output is the same incidence of the buses and the cells as a compressed sparse row matrix,
+    read with a single scan of the index of 'routes_cells'.
 
     Args:
         bus_ids (list): List of the bus ids.
+        output (str, optional): The output format. Valid values: 'lists', 'csr'. Defaults to 'lists'.
+        level (int, optional): The resolution level of the grid, 0 being the finest (see generate-grid.py).
+        Defaults to 0.
 
     Returns:
-        dict: The dict that contains a list of cells for each bus id. The cells are not necessarily ordered.
+        dict: For 'lists', the dict that contains a list of cells for each bus id. The cells are not necessarily ordered.
+        For 'csr', the dict with the rows of the matrix ('bus_ids', the sorted bus ids), its columns ('cell_ids',
+        the ids of all the cells ordered like get_grid_cells()), its 'shape' and the arrays 'indptr' and 'indices',
+        so that the cells of the bus in row i are indices[indptr[i]:indptr[i + 1]] (the layout of scipy.sparse).
     """
 
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
+    if output not in ('lists', 'csr'):
+        raise Exception('Invalid output!')
+
+    with connection() as conn:
+        cursor = conn.cursor()
+
+        if output == 'csr':
+            stmt = 'SELECT id FROM grid_cells WHERE level = ? ORDER BY id;'
+            cell_ids = np.array(cursor.execute(stmt, (level,)).fetchall(), dtype=np.int64).reshape(-1)
 
-    stmt = f"""SELECT bus_id, x_axis, y_axis FROM routes_cells rc, grid_cells gc 
-        WHERE rc.cell_id = gc.id AND bus_id IN ({','.join(['?'] * len(bus_ids))});"""
-    route_cells = cursor.execute(stmt, bus_ids).fetchall()
+            stmt = f"""SELECT bus_id, cell_id FROM routes_cells 
+                WHERE level = ? AND bus_id IN ({','.join(['?'] * len(bus_ids))}) ORDER BY bus_id, seq, id;"""
+            route_cells = np.array(cursor.execute(stmt, (level, *bus_ids)).fetchall(), dtype=np.int64).reshape(-1, 2)
 
-    route_cells_agg = {}
-    for bus_id, x_axis, y_axis in route_cells:
-        if bus_id not in route_cells_agg.keys():
-            route_cells_agg[bus_id] = []
-        route_cells_agg[bus_id].append((x_axis, y_axis))
+            cursor.close()
 
-    cursor.close()
-    conn.close()
+            return get_incidence_csr(sorted(set(bus_ids)), cell_ids, route_cells)
+
+        stmt = f"""SELECT bus_id, x_axis, y_axis FROM routes_cells rc, grid_cells gc 
+            WHERE rc.cell_id = gc.id AND rc.level = ? AND bus_id IN ({','.join(['?'] * len(bus_ids))})
+            ORDER BY bus_id, seq, rc.id;"""
+        route_cells = cursor.execute(stmt, (level, *bus_ids)).fetchall()
+
+        route_cells_agg = {}
+        for bus_id, x_axis, y_axis in route_cells:
+            if bus_id not in route_cells_agg.keys():
+                route_cells_agg[bus_id] = []
+            route_cells_agg[bus_id].append((x_axis, y_axis))
+
+        cursor.close()
 
     return route_cells_agg
 
 
+def get_incidence_csr(bus_ids, cell_ids, pairs):
+    """
+    Build the compressed sparse row incidence matrix of the buses and the cells, see get_route_cells().
+
+    Args:
+        bus_ids (list): The sorted bus ids, one for each row.
+        cell_ids (numpy.ndarray): The sorted cell ids, one for each column.
+        pairs (numpy.ndarray): The (bus_id, cell_id) pairs of shape (pairs, 2), sorted by bus id.
+        The cells missing from cell_ids are ignored.
+
+    Returns:
+        dict: The 'bus_ids', 'cell_ids', 'shape', 'indptr' and 'indices' of the matrix.
+    """
+
+    rows = np.searchsorted(np.array(bus_ids, dtype=np.int64), pairs[:, 0])
+    columns = np.searchsorted(cell_ids, pairs[:, 1])
+
+    valid = columns < len(cell_ids)
+    valid[valid] = cell_ids[columns[valid]] == pairs[valid, 1]
+
+    indptr = np.zeros(len(bus_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[valid], minlength=len(bus_ids)), out=indptr[1:])
+
+    return {
+        "bus_ids": list(bus_ids),
+        "cell_ids": cell_ids,
+        "shape": (len(bus_ids), len(cell_ids)),
+        "indptr": indptr,
+        "indices": columns[valid].astype(np.int32)
+    }
+
+
+@cached
+def get_cell_hours(bus_ids, stations_source='overpass', level=0):
+    """
+    Get the frequency of each bus in each cell of the grid for every hour and day type.
+    The departures of the buses are mapped to the cells through their stations, like in get_grid_geojson(),
+    and read from the aggregate table 'cells_frequencies', or from the table 'departures' when it is not built.
+    It can be used to calculate the covered cell-hours in the optimization algorithm.
+
+    Args:
+        bus_ids (list): List of the bus ids.
+        stations_source (str, optional): The source of the stations' coordinates.
+        Valid values: 'overpass', 'here'. Defaults to 'overpass'.
+        level (int, optional): The resolution level of the grid, 0 being the finest (see generate-grid.py).
+        Defaults to 0.
+
+    Returns:
+        dict: The dict that contains a list of (x_axis, y_axis, day, hour, count) tuples for each bus id.
+    """
+
+    if stations_source not in ('overpass', 'here'):
+        raise Exception('Invalid stations_source!')
+
+    with connection() as conn:
+        cursor = conn.cursor()
+
+        if is_aggregated(cursor, stations_source):
+            stmt = f"""SELECT bus_id, x_axis, y_axis, day, hour, count FROM cells_frequencies cf, grid_cells gc
+                WHERE cf.cell_id = gc.id AND gc.level = ? AND stations_source = ? 
+                AND bus_id IN ({','.join(['?'] * len(bus_ids))}) ORDER BY bus_id, x_axis, y_axis, day, hour;"""
+            cell_hours = cursor.execute(stmt, (level, stations_source, *bus_ids)).fetchall()
+        else:
+            stmt = f"""SELECT bus_id, x_axis, y_axis, day, substr(time, 0, 3) AS interval, count(*) 
+                FROM departures d, stations_cells_{stations_source} sc, grid_cells gc 
+                WHERE d.station_id = sc.station_id AND sc.cell_id = gc.id AND sc.level = ? 
+                AND bus_id IN ({','.join(['?'] * len(bus_ids))}) GROUP BY bus_id, x_axis, y_axis, day, interval 
+                ORDER BY bus_id, x_axis, y_axis, day, interval;"""
+            cell_hours = cursor.execute(stmt, (level, *bus_ids)).fetchall()
+
+        cell_hours_agg = {}
+        for bus_id, x_axis, y_axis, day, interval, count in cell_hours:
+            cell_hours_agg.setdefault(bus_id, []).append((x_axis, y_axis, day, int(interval), count))
+
+        cursor.close()
+
+    return cell_hours_agg
+
+
+def get_grid_cells(level=0):
+    """
+    Get the list with all the cells in the grid, ordered by their id.
+    The cells are in the same tuple format returned by get_route_cells(), so the position of a cell in the list
+    can be used as its index when encoding the coverage of the buses.
+
+    Args:
+        level (int, optional): The resolution level of the grid, 0 being the finest (see generate-grid.py).
+        Defaults to 0.
+
+    Returns:
+        list: The list of cells (x_axis, y_axis) in the grid.
+    """
+
+    with connection() as conn:
+        cursor = conn.cursor()
+
+        stmt = 'SELECT x_axis, y_axis FROM grid_cells WHERE level = ? ORDER BY id;'
+        grid_cells = cursor.execute(stmt, (level,)).fetchall()
+
+        cursor.close()
+
+    return [(x_axis, y_axis) for x_axis, y_axis in grid_cells]
+
+
+def get_grid_levels():
+    """
+    Get the resolution levels of the grid stored in the db, see generate-grid.py.
+
+    Returns:
+        dict: The number of cells along the x-axis and the y-axis for each level.
+    """
+
+    with connection() as conn:
+        cursor = conn.cursor()
+
+        stmt = 'SELECT level, max(x_axis) + 1, max(y_axis) + 1 FROM grid_cells GROUP BY level ORDER BY level;'
+        levels = cursor.execute(stmt).fetchall()
+
+        cursor.close()
+
+    return {level: (x_amount, y_amount) for level, x_amount, y_amount in levels}
+
+
+def get_cell_weights(path=None, level=0):
+    """
+    Get the importance weight of each cell in the grid, aligned with get_grid_cells() for the same level.
+    The weights are read from the table 'cells_weights' or from a CSV sidecar file with the header 'cell_id,weight',
+    where cell_id is the id in 'grid_cells'. The cells without a weight have weight 1.
+
+    Args:
+        path (str, optional): Path of the CSV sidecar file. Defaults to None (the table is used).
+        level (int, optional): The resolution level of the grid, 0 being the finest (see generate-grid.py).
+        Defaults to 0.
+
+    Returns:
+        list: The weight of each cell in the grid, ordered by the cell id.
+    """
+
+    with connection() as conn:
+        cursor = conn.cursor()
+
+        stmt = 'SELECT id FROM grid_cells WHERE level = ? ORDER BY id;'
+        cell_ids = [cell_id[0] for cell_id in cursor.execute(stmt, (level,)).fetchall()]
+
+        if path is None:
+            stmt = 'SELECT cell_id, weight FROM cells_weights;'
+            weights = dict(cursor.execute(stmt).fetchall())
+        else:
+            with open(path, 'r', newline='') as f:
+                weights = {int(row['cell_id']): float(row['weight']) for row in csv.DictReader(f)}
+
+        cursor.close()
+
+    return [weights.get(cell_id, 1.0) for cell_id in cell_ids]
+
+
 if __name__ == '__main__':
+    import folium
+    from folium.plugins import TimestampedGeoJson
+
     bus_ids = [13, 6]
     get_grid_geojson(bus_ids, ('weekday', '01:00', '10:00'))
     data = get_routes_geojson([10])
@@ -1,35 +1,141 @@
+import contextlib
+import heapq
 import itertools
+import math
+import os
+import tempfile
+import time
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
 
 import data_api as api
+from coverage_engine import DAYS, Coverage
+
+
+class Problem:
+    """
+    The optimization problem instance, loaded lazily from the db the first time its data is used.
+    The compiled routes coverage is cached on disk, keyed by the version of the db file (see get_db_version() in
+    data_api.py), so warm starts load it with NumPy and skip SQLite entirely.
+
+    Args:
+        cache_dir (Path, optional): The directory of the cache. Defaults to 'cache' next to the db.
+        level (int, optional): The resolution level of the grid, 0 being the finest (see generate-grid.py).
+        Defaults to 0.
+    """
+
+    def __init__(self, cache_dir=None, level=0):
+        self.cache_dir = cache_dir
+        self.level = level
+        self.coverage_cache = None
+        self.grid_cells_cache = None
+        self.all_bus_routes_cache = None
+
+    def load(self):
+        """
+        Load the routes coverage and the grid cells from the disk cache, or from the db when the cache is stale.
+        """
+
+        cache_dir = Path(self.cache_dir) if self.cache_dir is not None else api.db.parent / 'cache'
+        version = api.get_db_version()
+        path = cache_dir / f'coverage-{version}-{self.level}.npz'
+
+        if path.exists():
+            with np.load(path) as data:
+                bus_ids = data['bus_ids'].tolist()
+                grid_cells = [tuple(cell) for cell in data['grid_cells'].tolist()]
+                coverage = Coverage.from_bitsets(bus_ids, data['bitsets'], len(grid_cells))
+        else:
+            bus_ids = api.get_all_bus_ids()
+            grid_cells = api.get_grid_cells(self.level)
+            coverage = Coverage.from_csr(api.get_route_cells(bus_ids, output='csr', level=self.level))
+
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            for stale in cache_dir.glob('coverage-*.npz'):
+                if not stale.name.startswith(f'coverage-{version}-'): # The other levels of the same db are kept
+                    with contextlib.suppress(FileNotFoundError): # Already removed by another process
+                        stale.unlink()
+
+            # Write to a unique temporary file first, so that a concurrent reader never sees a partial cache
+            # and processes building the same cache at once do not overwrite each other's file
+            with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as f:
+                np.savez(f, bus_ids=np.array(coverage.bus_ids, dtype=np.int64),
+                         grid_cells=np.array(grid_cells, dtype=np.int64).reshape(-1, 2), bitsets=coverage.bitsets)
+            os.replace(f.name, path)
+
+        self.coverage_cache = coverage
+        self.grid_cells_cache = grid_cells
+
+    @property
+    def route_coverage(self):
+        if self.coverage_cache is None:
+            self.load()
+        return self.coverage_cache
+
+    @property
+    def grid_cells(self):
+        if self.grid_cells_cache is None:
+            self.load()
+        return self.grid_cells_cache
+
+    @property
+    def total_grid_amount(self):
+        return len(self.grid_cells)
+
+    @property
+    def all_bus_routes(self):
+        if self.all_bus_routes_cache is None:
+            coverage = self.route_coverage
+            self.all_bus_routes_cache = {bus_id: [self.grid_cells[cell] for cell in coverage.cells[index]]
+                                         for index, bus_id in enumerate(coverage.bus_ids) if len(coverage.cells[index])}
+        return self.all_bus_routes_cache
 
-# Initialisation
-# def init()
 
-# Anealing schedule
-# def schedule()
+problem = Problem()
+problems = {0: problem}
 
-# Candidate generator
-# def neighbour(s):
-#    s_new = []
-#
-#    return s_new
-#
-# Acceptance probability function
-# def P():
 
-# Energy (Goal) function
-# def E():
+def get_problem(level=0):
+    """
+    Get the optimization problem for a resolution level of the grid, so the coverage can be compared across levels
+    without regenerating the grid. The problem of each level is loaded once and shared.
 
+    Args:
+        level (int, optional): The resolution level of the grid, 0 being the finest (see generate-grid.py).
+        Defaults to 0.
 
-# api.get_bus_ids()
+    Returns:
+        Problem: The optimization problem at that level.
+    """
 
-all_bus_routes = api.get_route_cells(api.get_all_bus_ids())
-domain_all_bus_routes = list(all_bus_routes.values())
-range_all_bus_routes = list(all_bus_routes.keys())
-total_grid_amount = 100
+    if level not in problems:
+        problems[level] = Problem(level=level)
+
+    return problems[level]
+
+
+def __getattr__(name):
+    """
+    Resolve the module-level data (all_bus_routes, grid_cells, route_coverage, ...) lazily from the default problem,
+    so importing this module does not query the db.
+    """
+
+    if name in ('all_bus_routes', 'grid_cells', 'total_grid_amount', 'route_coverage'):
+        return getattr(problem, name)
+    if name == 'domain_all_bus_routes':
+        return list(problem.all_bus_routes.values())
+    if name == 'range_all_bus_routes':
+        return list(problem.all_bus_routes.keys())
+
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
 
 def get_max_coverage_single_bus():
+    all_bus_routes = problem.all_bus_routes
+    domain_all_bus_routes = list(all_bus_routes.values())
+    range_all_bus_routes = list(all_bus_routes.keys())
     bus_coverage = 0
     bus_id = 0
     bus_route = []
@@ -37,40 +143,811 @@ def get_max_coverage_single_bus():
     for route in domain_all_bus_routes:
         if len(route) >= max:
             bus_id = range_all_bus_routes[domain_all_bus_routes.index(route)]
-            bus_coverage = len(route) / total_grid_amount
+            bus_coverage = len(route) / problem.total_grid_amount
             bus_route = route
 
     return (bus_id, bus_coverage, bus_route)
 
 
 def get_bus_coverage(bus_id):
-    return len(all_bus_routes[bus_id]) / total_grid_amount
+    return len(problem.all_bus_routes[bus_id]) / problem.total_grid_amount
 
 
 def get_bus_coverage_combined(bus_list):
-    cell_set = set()
+    return problem.route_coverage.coverage(bus_list)
 
-    for bus_id in bus_list:
-        try:
-            bus_route = set(all_bus_routes[bus_id])
-        except:
-            bus_route = set()
 
-        cell_set = cell_set.union(bus_route)
+def get_time_coverage(stations_source='overpass', days=DAYS, weights=None, level=0):
+    """
+    Build the time-aware coverage, where the covered items are the (cell, hour, day type) triples in which
+    the buses depart from a station. It can be passed to the optimization algorithms in place of the routes coverage
+    to maximize the cell-hours observed.
 
-    return len(cell_set) / total_grid_amount
+    Args:
+        stations_source (str, optional): The source of the stations' coordinates.
+        Valid values: 'overpass', 'here'. Defaults to 'overpass'.
+        days (tuple, optional): The day types to cover. Defaults to all of them.
+        weights (list, optional): The weight of each cell, see get_cell_weights() in data_api.py.
+        Defaults to None (unweighted).
+        level (int, optional): The resolution level of the grid, 0 being the finest (see generate-grid.py).
+        Defaults to 0.
 
+    Returns:
+        Coverage: The coverage of the cell-hours by all the buses.
+    """
 
-if __name__ == '__main__':
-    stuff = api.get_all_bus_ids()
-    coverage = 0
-    comb = []
+    bus_ids = api.get_all_bus_ids()
+    cell_hours = api.get_cell_hours(bus_ids, stations_source, level)
+
+    return Coverage.from_cell_hours(cell_hours, get_problem(level).grid_cells, bus_ids, days, weights)
+
+
+def get_weighted_coverage(path=None, level=0):
+    """
+    Build the routes coverage weighted by the importance of each cell (schools, arterial roads, pollution hotspots).
+
+    Args:
+        path (str, optional): Path of the CSV sidecar file with the weights, see get_cell_weights() in data_api.py.
+        Defaults to None (the weights are read from the 'cells_weights' table).
+        level (int, optional): The resolution level of the grid, 0 being the finest (see generate-grid.py).
+        Defaults to 0.
+
+    Returns:
+        Coverage: The weighted coverage of the grid by all the buses.
+    """
+
+    return get_problem(level).route_coverage.weighted(api.get_cell_weights(path, level))
+
+
+def get_best_combination(k, batch_size=4096, coverage=None):
+    """
+    Search exhaustively the combination of k buses with the highest coverage.
+    The combinations are evaluated in batches with the bitset coverage engine.
+
+    Args:
+        k (int): The number of buses in the combination.
+        batch_size (int, optional): The number of combinations evaluated at once. Defaults to 4096.
+        coverage (Coverage, optional): The coverage to maximize. Defaults to the routes coverage.
+
+    Returns:
+        tuple: The best combination of bus ids and its coverage.
+    """
+
+    if coverage is None:
+        coverage = problem.route_coverage
+
+    combinations = itertools.combinations(range(coverage.buses_amount), k)
+    best_count = -1
+    best_subset = []
+
+    while True:
+        batch = np.array(list(itertools.islice(combinations, batch_size)), dtype=np.intp).reshape(-1, k)
+        if not len(batch):
+            break
+
+        counts = coverage.evaluate(batch, batch_size)
+        index = int(counts.argmax())
+        if best_count < counts[index]:
+            best_count = counts[index].item()
+            best_subset = batch[index].tolist()
+
+    return [coverage.bus_ids[index] for index in best_subset], best_count / coverage.total
+
+
+def get_greedy_selection(k, coverage=None):
+    """
+    Select k buses by greedy marginal coverage, using lazy re-evaluation (CELF).
+    The marginal gains are kept in a priority queue and, since they can only decrease as buses are selected,
+    a stale gain at the top of the queue is recomputed and pushed back until the top gain is up to date.
+    Coverage is submodular, so the greedy selection covers at least (1 - 1/e) of the optimal k buses coverage.
+
+    Args:
+        k (int): The number of buses to select.
+        coverage (Coverage, optional): The coverage to maximize. Defaults to the routes coverage.
+
+    Returns:
+        tuple: The ordered list of selected bus ids, the marginal gain (in cells) of each step and the upper bound
+        on the optimal coverage (in cells) that follows from the (1 - 1/e) guarantee.
+    """
+
+    if coverage is None:
+        coverage = problem.route_coverage
+
+    covered = coverage.union([])
+    queue = [(-size, index, 0) for index, size in enumerate(coverage.sizes.tolist())]
+    heapq.heapify(queue)
+
+    selection = []
+    gains = []
+
+    while queue and len(selection) < k:
+        gain, index, step = heapq.heappop(queue)
+
+        if step == len(selection):
+            selection.append(index)
+            gains.append(-gain)
+            covered |= coverage.bitsets[index]
+        else:
+            heapq.heappush(queue, (-coverage.marginal(index, covered), index, len(selection)))
+
+    upper_bound = min(sum(gains) / (1 - 1 / math.e), coverage.total)
+
+    return [coverage.bus_ids[index] for index in selection], gains, upper_bound
+
+
+# Simulated annealing over subsets of k buses.
+# The state is the list of selected buses together with the number of selected buses covering each cell,
+# so swapping a bus only touches the cells of the bus leaving and the bus entering.
+# The cooling schedule is selected by name, so the arguments of the chains can be pickled for the process pool.
+
+SCHEDULES = ('exponential', 'linear', 'logarithmic')
+
+
+def init(coverage, k, rng):
+    """
+    Initialise the annealing state with k random buses.
+
+    Args:
+        coverage (Coverage): The coverage to maximize.
+        k (int): The number of buses to select.
+        rng (numpy.random.Generator): The random generator of the chain.
+
+    Returns:
+        tuple: The row indices of the selected buses, the boolean mask of the selected buses and
+        the cover count of each cell.
+    """
+
+    selection = rng.choice(coverage.buses_amount, size=k, replace=False)
+    selected = np.zeros(coverage.buses_amount, dtype=bool)
+    selected[selection] = True
+
+    counts = np.zeros(coverage.cells_amount, dtype=np.int32)
+    for index in selection:
+        counts[coverage.cells[index]] += 1
+
+    return selection, selected, counts
+
+
+def schedule(step, steps, t_start, t_end, kind='exponential'):
+    """
+    Compute the temperature of the annealing schedule at the given step.
+
+    Args:
+        step (int): The current step.
+        steps (int): The total number of steps.
+        t_start (float): The initial temperature.
+        t_end (float): The final temperature.
+        kind (str, optional): The cooling schedule. Valid values: 'exponential', 'linear', 'logarithmic'.
+        Defaults to 'exponential'.
+
+    Returns:
+        float: The temperature.
+    """
+
+    progress = step / steps
+
+    if kind == 'exponential':
+        return t_start * (t_end / t_start) ** progress
+    elif kind == 'linear':
+        return t_start - (t_start - t_end) * progress
+    elif kind == 'logarithmic':
+        return max(t_end, t_start / math.log(math.e + step))
+    else:
+        raise Exception('Invalid cooling schedule!')
+
+
+def neighbour(coverage, selection, selected, rng):
+    """
+    Generate a candidate move that swaps a selected bus with one that is not selected.
+
+    Args:
+        coverage (Coverage): The coverage to maximize.
+        selection (numpy.ndarray): The row indices of the selected buses.
+        selected (numpy.ndarray): The boolean mask of the selected buses.
+        rng (numpy.random.Generator): The random generator of the chain.
+
+    Returns:
+        tuple: The position in the selection of the bus leaving and the row index of the bus entering.
+    """
+
+    position = int(rng.integers(len(selection)))
+    bus_in = int(rng.integers(coverage.buses_amount))
+    while selected[bus_in]:
+        bus_in = int(rng.integers(coverage.buses_amount))
+
+    return position, bus_in
+
+
+def P(delta, temperature):
+    """
+    Compute the acceptance probability of a move (Metropolis criterion).
+
+    Args:
+        delta (int or float): The change in covered cells (or their weight) caused by the move.
+        temperature (float): The current temperature.
+
+    Returns:
+        float: The probability of accepting the move.
+    """
+
+    if delta >= 0:
+        return 1.0
+    if temperature <= 0:
+        return 0.0
+
+    return math.exp(delta / temperature)
+
+
+def E(coverage, counts):
+    """
+    Compute the energy of a state, that is the opposite of the number (or weight) of covered cells.
+
+    Args:
+        coverage (Coverage): The coverage to maximize.
+        counts (numpy.ndarray): The cover count of each cell.
+
+    Returns:
+        int or float: The energy.
+    """
+
+    return -coverage.measure_cells(np.flatnonzero(counts))
+
+
+def anneal(coverage, k, steps, t_start, t_end, kind, seed):
+    """
+    Run a single simulated annealing chain.
+    The energy is updated incrementally: the cover counts of the cells of the bus leaving are decremented and the
+    cells that drop to zero are lost, while the cells of the bus entering that are at zero are gained.
+
+    Args:
+        coverage (Coverage): The coverage to maximize.
+        k (int): The number of buses to select.
+        steps (int): The number of steps of the chain.
+        t_start (float): The initial temperature.
+        t_end (float): The final temperature.
+        kind (str): The cooling schedule, see schedule().
+        seed (numpy.random.SeedSequence or int): The seed of the chain.
+
+    Returns:
+        tuple: The row indices of the best selection found and its number of covered cells.
+    """
+
+    rng = np.random.default_rng(seed)
+    selection, selected, counts = init(coverage, k, rng)
+    energy = E(coverage, counts)
+
+    best_energy = energy
+    best_selection = selection.copy()
+
+    if k == 0 or k == coverage.buses_amount:
+        return best_selection.tolist(), -best_energy
+
+    for step in range(steps):
+        temperature = schedule(step, steps, t_start, t_end, kind)
+        position, bus_in = neighbour(coverage, selection, selected, rng)
+        cells_out = coverage.cells[selection[position]]
+        cells_in = coverage.cells[bus_in]
+
+        counts[cells_out] -= 1
+        delta = coverage.measure_cells(cells_in[counts[cells_in] == 0]) - \
+            coverage.measure_cells(cells_out[counts[cells_out] == 0])
+
+        if rng.random() < P(delta, temperature):
+            counts[cells_in] += 1
+            selected[selection[position]] = False
+            selected[bus_in] = True
+            selection[position] = bus_in
+            energy -= delta
+
+            if energy < best_energy:
+                best_energy = energy
+                best_selection = selection.copy()
+        else:
+            counts[cells_out] += 1
+
+    return best_selection.tolist(), -best_energy
+
+
+def get_annealing_selection(k, steps=20000, t_start=2.0, t_end=0.01, kind='exponential', seed=None, chains=1,
+                            processes=None, coverage=None):
+    """
+    Select k buses with simulated annealing, running several independent chains in parallel.
+    The chains are seeded from a single seed, so runs with the same seed are reproducible.
+
+    Args:
+        k (int): The number of buses to select.
+        steps (int, optional): The number of steps of each chain. Defaults to 20000.
+        t_start (float, optional): The initial temperature. Defaults to 2.0.
+        t_end (float, optional): The final temperature. Defaults to 0.01.
+        kind (str, optional): The cooling schedule, see schedule(). Defaults to 'exponential'.
+        seed (int, optional): The seed of the run. Defaults to None.
+        chains (int, optional): The number of independent chains. Defaults to 1.
+        processes (int, optional): The number of processes in the pool. Defaults to the number of CPUs.
+        coverage (Coverage, optional): The coverage to maximize. Defaults to the routes coverage.
+
+    Returns:
+        tuple: The best selection of bus ids and its number of covered cells.
+    """
+
+    if kind not in SCHEDULES:
+        raise Exception('Invalid cooling schedule!')
+
+    if coverage is None:
+        coverage = problem.route_coverage
+
+    seeds = np.random.SeedSequence(seed).spawn(chains)
+    tasks = [(coverage, k, steps, t_start, t_end, kind, chain_seed) for chain_seed in seeds]
+
+    if chains == 1:
+        results = [anneal(*tasks[0])]
+    else:
+        with Pool(processes) as pool:
+            results = pool.starmap(anneal, tasks)
+
+    selection, count = max(results, key=lambda result: result[1])
+
+    return [coverage.bus_ids[index] for index in selection], count
+
+
+def get_optimal_selection(k, time_limit=None, coverage=None):
+    """
+    Select the k buses with the maximum coverage using branch and bound.
+    The buses whose cells are a subset of another bus's cells are dropped first, since swapping them for the other
+    bus never decreases the coverage. The search starts from the greedy selection and prunes every branch whose
+    upper bound, the covered cells plus the sum of the top remaining marginal gains, does not beat the incumbent.
+
+    Args:
+        k (int): The number of buses to select.
+        time_limit (float, optional): The maximum search time in seconds. Defaults to None (no limit).
+        coverage (Coverage, optional): The coverage to maximize. Defaults to the routes coverage.
+
+    Returns:
+        tuple: The best selection of bus ids, its number of covered cells, the upper bound on the optimal number
+        of covered cells and the optimality gap (0 when the selection is proven optimal).
+    """
+
+    if coverage is None:
+        coverage = problem.route_coverage
+
+    deadline = time.perf_counter() + time_limit if time_limit is not None else None
+    candidates = np.flatnonzero(~coverage.dominated() & (coverage.sizes > 0))
+
+    greedy_selection, greedy_gains, _ = get_greedy_selection(k, coverage)
+    best = {'selection': coverage.indices(greedy_selection), 'count': sum(greedy_gains)}
+
+    def search(selection, covered, count, candidates):
+        """
+        Explore the selections that extend the given one with the given candidates.
+
+        Returns:
+            int: The upper bound of the branches left unexplored because of the time limit, -1 if there are none.
+        """
+
+        remaining = k - len(selection)
+        gains = coverage.marginals(candidates, covered)
+        order = np.argsort(-gains, kind='stable')
+        candidates = candidates[order][gains[order] > 0]
+        gains = gains[order][gains[order] > 0]
+
+        if count > best['count']:
+            best['selection'] = list(selection)
+            best['count'] = count
 
-    for subset in itertools.combinations(stuff, 2):
-        cur_coverage = get_bus_coverage_combined(list(subset))
-        if coverage < cur_coverage:
-            coverage = cur_coverage
-            comb = list(subset)
+        if remaining == 0 or not len(candidates):
+            return -1
+
+        # The candidates are sorted by gain, so the bounds of the next branches can only decrease
+        for position in range(len(candidates)):
+            bound = min(count + gains[position:position + remaining].sum().item(), coverage.total)
+            if bound <= best['count']:
+                return -1
+
+            if deadline is not None and time.perf_counter() > deadline:
+                return bound
+
+            index = candidates[position]
+            unexplored = search(selection + [index], covered | coverage.bitsets[index],
+                                count + gains[position].item(), candidates[position + 1:])
+
+            if unexplored >= 0:
+                next_bound = min(count + gains[position + 1:position + 1 + remaining].sum().item(), coverage.total)
+                return max(unexplored, next_bound)
+
+        return -1
+
+    unexplored = search([], coverage.union([]), 0, candidates)
+
+    selection = best['selection']
+    for index in range(coverage.buses_amount):
+        if len(selection) >= k:
+            break
+        if index not in selection:
+            selection.append(index)
+
+    upper_bound = max(best['count'], unexplored)
+    gap = (upper_bound - best['count']) / upper_bound if upper_bound else 0.0
+
+    return [coverage.bus_ids[index] for index in selection], best['count'], upper_bound, gap
+
+
+# Genetic algorithm over subsets of k buses.
+# The whole population is kept in a single array of bus indices and evaluated at once with Coverage.evaluate(),
+# while crossover and mutation work on boolean masks over the buses that are repaired back to exactly k buses.
+
+def repair(priorities, k):
+    """
+    Turn priorities over the buses into chromosomes of exactly k distinct buses, keeping the highest priorities.
+
+    Args:
+        priorities (numpy.ndarray): Float matrix of shape (population, buses).
+        k (int): The number of buses in each chromosome.
+
+    Returns:
+        numpy.ndarray: Integer matrix of shape (population, k) with the row indices of the buses.
+    """
+
+    return np.argpartition(-priorities, k - 1, axis=1)[:, :k]
+
+
+def to_masks(population, buses_amount):
+    """
+    Convert chromosomes of bus indices into boolean masks over the buses.
+
+    Args:
+        population (numpy.ndarray): Integer matrix of shape (population, k) with the row indices of the buses.
+        buses_amount (int): The number of buses.
+
+    Returns:
+        numpy.ndarray: Boolean matrix of shape (population, buses).
+    """
+
+    masks = np.zeros((len(population), buses_amount), dtype=bool)
+    masks[np.arange(len(population))[:, np.newaxis], population] = True
+
+    return masks
+
+
+def get_genetic_selection(k, population_size=256, generations=200, elite=4, tournament=2, mutation_rate=None,
+                          seed=None, coverage=None):
+    """
+    Select k buses with a genetic algorithm whose population is evaluated as a whole in every generation.
+    Parents are chosen by tournament, children inherit first the buses of both parents, then those of either parent,
+    and mutation replaces buses at random. Duplicated buses are repaired by filling the chromosome with random buses.
+
+    Args:
+        k (int): The number of buses to select.
+        population_size (int, optional): The number of chromosomes. Defaults to 256.
+        generations (int, optional): The number of generations. Defaults to 200.
+        elite (int, optional): The number of best chromosomes copied unchanged to the next generation. Defaults to 4.
+        tournament (int, optional): The number of chromosomes competing to be a parent. Defaults to 2.
+        mutation_rate (float, optional): The probability of replacing each bus of a child. Defaults to 1 / k.
+        seed (int, optional): The seed of the run. Defaults to None.
+        coverage (Coverage, optional): The coverage to maximize. Defaults to the routes coverage.
+
+    Returns:
+        tuple: The best selection of bus ids and its number of covered cells.
+    """
+
+    if coverage is None:
+        coverage = problem.route_coverage
+
+    if elite >= population_size:
+        raise Exception('The elite must be smaller than the population!')
+    if tournament < 1:
+        raise Exception('The tournament needs at least one chromosome!')
+    if k > coverage.buses_amount:
+        raise Exception('Cannot select more buses than there are!')
+
+    rng = np.random.default_rng(seed)
+    buses_amount = coverage.buses_amount
+    if k == 0:
+        return [], coverage.count([])
+    if mutation_rate is None:
+        mutation_rate = 1 / k
+
+    children_amount = population_size - elite
+
+    population = repair(rng.random((population_size, buses_amount)), k)
+    fitness = coverage.evaluate(population)
+
+    for generation in range(generations):
+        order = np.argsort(-fitness, kind='stable')
+        elites = population[order[:elite]]
+
+        contenders = rng.integers(population_size, size=(2 * children_amount, tournament))
+        winners = contenders[np.arange(2 * children_amount), fitness[contenders].argmax(axis=1)]
+        parents = population[winners]
+
+        inherited = to_masks(parents[:children_amount], buses_amount).astype(np.float64) + \
+            to_masks(parents[children_amount:], buses_amount)
+        children = repair(inherited + rng.random((children_amount, buses_amount)), k)
+
+        mutated = rng.random((children_amount, k)) < mutation_rate
+        children[mutated] = rng.integers(buses_amount, size=int(mutated.sum()))
+        children = repair(to_masks(children, buses_amount) + rng.random((children_amount, buses_amount)), k)
+
+        population = np.concatenate([elites, children])
+        fitness = coverage.evaluate(population)
+
+    best = int(fitness.argmax())
+
+    return [coverage.bus_ids[index] for index in np.sort(population[best])], fitness[best].item()
+
+
+# Sharded exhaustive enumeration.
+# The combinations are ranked in colexicographic order, so a shard is a range of ranks that can be unranked
+# in batches with the combinatorial number system, without iterating over the combinations before it.
+
+# Coverage shared by the enumeration workers, set once per process by init_enumeration_worker()
+enumeration_coverage = None
+
+
+def get_binomials(n, k):
+    """
+    Compute the table of binomial coefficients C(c, i) for c <= n and i <= k.
+
+    Args:
+        n (int): The number of elements.
+        k (int): The size of the combinations.
+
+    Returns:
+        numpy.ndarray: The int64 matrix of shape (n + 1, k + 1) with C(c, i) in position (c, i).
+    """
+
+    binomials = [[1] + [0] * k]
+    for c in range(1, n + 1):
+        previous = binomials[-1]
+        binomials.append([1] + [previous[i - 1] + previous[i] for i in range(1, k + 1)])
+
+    if binomials[-1][k] >= 2 ** 63:
+        raise Exception('Too many combinations to rank!')
+
+    return np.array(binomials, dtype=np.int64)
+
+
+def unrank_combinations(ranks, k, binomials):
+    """
+    Compute the combinations with the given colexicographic ranks.
+
+    Args:
+        ranks (numpy.ndarray): The int64 ranks.
+        k (int): The size of the combinations.
+        binomials (numpy.ndarray): The binomial coefficients table, see get_binomials().
+
+    Returns:
+        numpy.ndarray: Integer matrix of shape (ranks, k) with the ascending combinations.
+    """
+
+    ranks = np.array(ranks, dtype=np.int64)
+    combinations = np.empty((len(ranks), k), dtype=np.intp)
+
+    for i in range(k, 0, -1):
+        column = binomials[:-1, i]
+        elements = np.searchsorted(column, ranks, side='right') - 1
+        combinations[:, i - 1] = elements
+        ranks -= column[elements]
+
+    return combinations
+
+
+def init_enumeration_worker(coverage):
+    global enumeration_coverage
+    enumeration_coverage = coverage
+
+
+def evaluate_shard(shard):
+    """
+    Evaluate the combinations in a range of ranks and keep the best ones.
+
+    Args:
+        shard (tuple): The start and stop ranks, the size of the combinations, the number of results to keep,
+        the binomial coefficients table and the batch size.
+
+    Returns:
+        tuple: The number of evaluated combinations and the ranks and number of covered cells of the best ones.
+    """
+
+    start, stop, k, top, binomials, batch_size = shard
+    best_ranks = np.empty(0, dtype=np.int64)
+    best_counts = np.empty(0, dtype=np.int64)
+
+    for batch_start in range(start, stop, batch_size):
+        ranks = np.arange(batch_start, min(batch_start + batch_size, stop), dtype=np.int64)
+        counts = enumeration_coverage.evaluate(unrank_combinations(ranks, k, binomials), batch_size)
+
+        best_ranks = np.concatenate([best_ranks, ranks])
+        best_counts = np.concatenate([best_counts, counts])
+        order = np.lexsort((best_ranks, -best_counts))[:top]
+        best_ranks = best_ranks[order]
+        best_counts = best_counts[order]
+
+    return stop - start, best_ranks, best_counts
+
+
+def get_top_combinations(k, top=10, processes=None, shards=None, batch_size=16384, progress=None, coverage=None):
+    """
+    Search exhaustively the combinations of k buses with the highest coverage across a process pool.
+    The combination space is split into shards of consecutive ranks, the coverage is sent once to each worker
+    when the pool starts and every shard returns only its best combinations, which are reduced to the global ones.
+
+    Args:
+        k (int): The number of buses in the combinations.
+        top (int, optional): The number of combinations to return. Defaults to 10.
+        processes (int, optional): The number of processes in the pool. Defaults to the number of CPUs.
+        shards (int, optional): The number of shards. Defaults to 16 times the number of processes.
+        batch_size (int, optional): The number of combinations evaluated at once. Defaults to 16384.
+        progress (callable, optional): Function called with the number of evaluated combinations and the total
+        number of combinations every time a shard is done. Defaults to None.
+        coverage (Coverage, optional): The coverage to maximize. Defaults to the routes coverage.
+
+    Returns:
+        list: The best combinations as tuples of the list of bus ids and the number of covered cells,
+        sorted by coverage.
+    """
+
+    if coverage is None:
+        coverage = problem.route_coverage
+
+    binomials = get_binomials(coverage.buses_amount, k)
+    total = int(binomials[coverage.buses_amount, k])
+
+    if shards is None:
+        shards = 16 * (processes or os.cpu_count() or 1)
+
+    with Pool(processes, initializer=init_enumeration_worker, initargs=(coverage,)) as pool:
+        bounds = np.linspace(0, total, min(shards, total) + 1, dtype=np.int64)
+        tasks = [(int(start), int(stop), k, top, binomials, batch_size)
+                 for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+        done = 0
+        ranks = [np.empty(0, dtype=np.int64)]
+        counts = [np.empty(0, dtype=np.int64)]
+        for evaluated, shard_ranks, shard_counts in pool.imap_unordered(evaluate_shard, tasks):
+            done += evaluated
+            ranks.append(shard_ranks)
+            counts.append(shard_counts)
+            if progress is not None:
+                progress(done, total)
+
+    ranks = np.concatenate(ranks)
+    counts = np.concatenate(counts)
+    order = np.lexsort((ranks, -counts))[:top]
+    combinations = unrank_combinations(ranks[order], k, binomials)
+
+    return [([coverage.bus_ids[index] for index in combination], count.item())
+            for combination, count in zip(combinations, counts[order])]
+
+
+def improve_selection(selection, coverage=None):
+    """
+    Refine a selection of buses with best-improvement swaps until no swap increases the coverage.
+    For each selected bus, the union of the other buses is computed from prefix and suffix unions and the gain of
+    every bus that is not selected is evaluated against it at once.
+
+    Args:
+        selection (list): The row indices of the selected buses.
+        coverage (Coverage, optional): The coverage to maximize. Defaults to the routes coverage.
+
+    Returns:
+        tuple: The row indices of the refined selection and its number of covered cells.
+    """
+
+    if coverage is None:
+        coverage = problem.route_coverage
+
+    selection = list(selection)
+    value = coverage.count(selection)
+
+    while selection:
+        prefixes = [coverage.union([])]
+        for index in selection:
+            prefixes.append(prefixes[-1] | coverage.bitsets[index])
+        suffixes = [coverage.union([])]
+        for index in reversed(selection):
+            suffixes.append(suffixes[-1] | coverage.bitsets[index])
+        suffixes.reverse()
+
+        candidates = np.setdiff1d(np.arange(coverage.buses_amount), selection)
+        if not len(candidates):
+            break
+
+        best_value, best_swap = value, None
+        for position in range(len(selection)):
+            others = prefixes[position] | suffixes[position + 1]
+            gains = coverage.marginals(candidates, others)
+            candidate = int(gains.argmax())
+            swap_value = coverage.measure(others).item() + gains[candidate].item()
+            if swap_value > best_value + 1e-9:
+                best_value, best_swap = swap_value, (position, candidates[candidate])
+
+        if best_swap is None:
+            break
+
+        selection[best_swap[0]] = int(best_swap[1])
+        value = best_value
+
+    return selection, value
+
+
+def get_pareto_frontier(max_k, coverage=None):
+    """
+    Compute the coverage for every number of buses from 1 to max_k in a single run.
+    The greedy selection of max_k buses gives a starting point for every k through its prefixes, and the refined
+    solution for k - 1 extended with its best bus gives another one. The better of the two is refined with
+    improve_selection(), so the coverage never decreases when a bus is added.
+
+    Args:
+        max_k (int): The largest number of buses.
+        coverage (Coverage, optional): The coverage to maximize. Defaults to the routes coverage.
+
+    Returns:
+        list: A dict for each number of buses with the keys 'k', 'bus_ids', 'covered' (number of covered cells)
+        and 'coverage' (covered ratio).
+    """
+
+    if coverage is None:
+        coverage = problem.route_coverage
+
+    greedy_selection, _, _ = get_greedy_selection(max_k, coverage)
+    greedy_selection = coverage.indices(greedy_selection)
+
+    frontier = []
+    previous = []
+
+    for k in range(1, min(max_k, coverage.buses_amount) + 1):
+        starts = [greedy_selection[:k]]
+
+        candidates = np.setdiff1d(np.arange(coverage.buses_amount), previous)
+        gains = coverage.marginals(candidates, coverage.union(previous))
+        starts.append(previous + [int(candidates[int(gains.argmax())])])
+
+        start = max(starts, key=coverage.count)
+        previous, covered = improve_selection(start, coverage)
+
+        frontier.append({
+            'k': k,
+            'bus_ids': [coverage.bus_ids[index] for index in previous],
+            'covered': covered,
+            'coverage': covered / coverage.total if coverage.total else 0.0
+        })
+
+    return frontier
+
+
+if __name__ == '__main__':
+    comb, coverage_ratio = get_best_combination(2)
 
     print("Best combination: ", comb)
-    print("Coverage: ", coverage)
+    print("Coverage: ", coverage_ratio)
+
+    for comb, count in get_top_combinations(3, top=5):
+        print("Top combination: ", comb, "Coverage: ", count / problem.total_grid_amount)
+
+    selection, gains, upper_bound = get_greedy_selection(10)
+
+    print("Greedy selection: ", selection)
+    print("Marginal gains: ", gains)
+    print("Coverage: ", sum(gains) / problem.total_grid_amount)
+    print("Optimal coverage at most: ", upper_bound / problem.total_grid_amount)
+
+    selection, count = get_annealing_selection(10, seed=0, chains=4)
+
+    print("Annealing selection: ", selection)
+    print("Coverage: ", count / problem.total_grid_amount)
+
+    selection, count, upper_bound, gap = get_optimal_selection(10, time_limit=60)
+
+    print("Branch and bound selection: ", selection)
+    print("Coverage: ", count / problem.total_grid_amount)
+    print("Optimality gap: ", gap)
+
+    selection, count = get_genetic_selection(10, seed=0)
+
+    print("Genetic selection: ", selection)
+    print("Coverage: ", count / problem.total_grid_amount)
+
+    time_coverage = get_time_coverage()
+    selection, gains, upper_bound = get_greedy_selection(10, time_coverage)
+
+    print("Time-aware greedy selection: ", selection)
+    print("Cell-hours coverage: ", sum(gains) / time_coverage.total)
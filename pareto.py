@@ -0,0 +1,56 @@
+"""
+This script computes the frontier of the coverage versus the number of buses equipped with sensors
+and saves it as JSON, so the tradeoff can be plotted without re-running the optimization.
+"""
+
+import argparse
+import json
+
+import optimize
+
+
+def format_frontier(frontier):
+    """
+    Format the frontier as a text table.
+
+    Args:
+        frontier (list): The frontier, as returned by get_pareto_frontier() in optimize.py.
+
+    Returns:
+        str: The table with one row for each number of buses.
+    """
+
+    lines = [f"{'k':>3}  {'covered':>10}  {'coverage':>9}  {'delta':>7}  bus_ids"]
+    previous = 0.0
+
+    for point in frontier:
+        delta = point['coverage'] - previous
+        previous = point['coverage']
+        lines.append(f"{point['k']:>3}  {point['covered']:>10g}  {point['coverage'] * 100:>8.2f}%  "
+                     f"{delta * 100:>+6.2f}%  {point['bus_ids']}")
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the coverage vs number of buses frontier.')
+    parser.add_argument('max_k', type=int, help='The largest number of buses.')
+    parser.add_argument('--output', default='data/frontier.json', help='Path of the JSON output.')
+    parser.add_argument('--time-aware', action='store_true', help='Maximize the cell-hours instead of the cells.')
+    parser.add_argument('--weights', nargs='?', const='', default=None,
+                        help='Weight the cells, from the CSV file if given or else from the table cells_weights.')
+    parser.add_argument('--level', type=int, default=0, help='The resolution level of the grid, 0 being the finest.')
+    args = parser.parse_args()
+
+    weights = None if args.weights is None else optimize.api.get_cell_weights(args.weights or None, args.level)
+    if args.time_aware:
+        coverage = optimize.get_time_coverage(weights=weights, level=args.level)
+    else:
+        coverage = optimize.get_problem(args.level).route_coverage.weighted(weights)
+
+    frontier = optimize.get_pareto_frontier(args.max_k, coverage)
+
+    print(format_frontier(frontier))
+
+    with open(args.output, 'w') as f:
+        json.dump(frontier, f, indent=2)
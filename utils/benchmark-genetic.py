@@ -0,0 +1,65 @@
+import sys
+import timeit
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path.cwd().parent))
+
+import data_api as api
+import optimize
+
+db = Path.cwd().parent / 'data/main.db'
+api.db = db
+
+
+def evaluate_per_chromosome(coverage, population):
+    """
+    The evaluation of a generation one chromosome at a time, kept as the baseline of the benchmark.
+
+    Args:
+        coverage (Coverage): The coverage to maximize.
+        population (numpy.ndarray): The bus indices of each chromosome, of shape (chromosomes, k).
+
+    Returns:
+        numpy.ndarray: The number of covered cells of each chromosome.
+    """
+
+    return np.array([coverage.count(chromosome) for chromosome in population])
+
+
+def benchmark_genetic(sizes, k=5, repeat=5):
+    """
+    Compares the time needed to evaluate a generation of get_genetic_selection() in optimize.py chromosome by
+    chromosome (before) and as a whole with Coverage.evaluate() (after) for an increasing population size,
+    and prints the results.
+
+    Args:
+        sizes (list of int): The population sizes.
+        k (int, optional): The number of buses of each chromosome. Defaults to 5.
+        repeat (int, optional): The number of runs, the best one is reported. Defaults to 5.
+
+    Returns:
+        None
+    """
+
+    coverage = optimize.problem.route_coverage
+    rng = np.random.default_rng(0)
+    k = min(k, coverage.buses_amount)
+
+    print(f"{'population':>10}  {'before (ms)':>12}  {'after (ms)':>11}  {'speedup':>8}")
+
+    for size in sizes:
+        population = optimize.repair(rng.random((size, coverage.buses_amount)), k)
+
+        if not np.array_equal(evaluate_per_chromosome(coverage, population), coverage.evaluate(population)):
+            raise Exception('The fitness of the two implementations differ!')
+
+        before = min(timeit.repeat(lambda: evaluate_per_chromosome(coverage, population), number=1, repeat=repeat))
+        after = min(timeit.repeat(lambda: coverage.evaluate(population), number=1, repeat=repeat))
+
+        print(f"{size:>10}  {before * 1000:>12.1f}  {after * 1000:>11.1f}  {before / after:>7.1f}x")
+
+
+if __name__ == '__main__':
+    benchmark_genetic([64, 256, 1024, 4096])
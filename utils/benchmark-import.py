@@ -0,0 +1,54 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+root = Path.cwd().parent
+
+# The modules that 'import data_api' must not load, they are imported by the functions that use them
+LAZY_MODULES = ('folium', 'matplotlib', 'datetimerange')
+
+# Maximum time in seconds of 'import data_api' in a fresh interpreter
+THRESHOLD = 0.5
+
+
+def benchmark_import(threshold=THRESHOLD, repeat=5):
+    """
+    Measures the time of 'import data_api' in fresh interpreters and prints the results.
+    It fails when the best run exceeds the threshold or when one of LAZY_MODULES is imported with the module,
+    so that it can be run as a check after changing the imports of data_api.py.
+
+    Args:
+        threshold (float, optional): The maximum import time in seconds. Defaults to THRESHOLD.
+        repeat (int, optional): The number of runs, the best one is compared to the threshold. Defaults to 5.
+
+    Returns:
+        float: The best import time in seconds.
+    """
+
+    code = f"""import json, sys, time
+start = time.perf_counter()
+import data_api
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [module for module in {LAZY_MODULES!r} if module in sys.modules]]))"""
+
+    times = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', code], cwd=root, stdout=subprocess.PIPE, check=True)
+        elapsed, eager_modules = json.loads(result.stdout)
+        times.append(elapsed)
+
+        if eager_modules:
+            raise Exception(f"'import data_api' imports {', '.join(eager_modules)}!")
+
+    best = min(times)
+    print(f'import data_api: best {best * 1000:.1f} ms, worst {max(times) * 1000:.1f} ms (threshold {threshold * 1000:.0f} ms)')
+
+    if best > threshold:
+        raise Exception('The import of data_api is slower than the threshold!')
+
+    return best
+
+
+if __name__ == '__main__':
+    benchmark_import()
@@ -0,0 +1,106 @@
+import sqlite3
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path.cwd().parent))
+
+import data_api as api
+
+db = Path.cwd().parent / 'data/main.db'
+api.db = db
+
+
+def get_routes_geojson_per_segment(bus_ids, flip_coordinates=True):
+    """
+    The previous implementation of get_routes_geojson() in data_api.py, kept as the baseline of the benchmark.
+    It runs one query per bus for the segments and one query per segment for the coordinates.
+
+    Args:
+        bus_ids (list): List of the bus ids.
+        flip_coordinates (bool, optional): Flip the coordinates to comply with GeoJson. Defaults to True.
+
+    Returns:
+        dict: The dict that represents the GeoJson.
+    """
+
+    conn = sqlite3.connect(db)
+    cursor = conn.cursor()
+
+    geo_json = {
+        "type": "FeatureCollection",
+        "properties": {
+            "bus_ids": bus_ids
+        },
+        "features": []
+    }
+
+    stmt = f"""SELECT id, name, from_station_name, to_station_name FROM buses
+        WHERE id IN ({','.join(['?'] * len(bus_ids))});"""
+    buses = cursor.execute(stmt, bus_ids).fetchall()
+
+    for bus_id, name, from_station, to_station in buses:
+        stmt = 'SELECT DISTINCT segment FROM routes_points WHERE bus_id = ? ORDER BY segment;'
+        segments = cursor.execute(stmt, [bus_id]).fetchall()
+        coordinates_list = []
+        for segment in segments:
+            stmt_sub = 'SELECT coordinates FROM routes_points WHERE bus_id = ? AND segment = ? ORDER BY segment, seq;'
+            coordinates = cursor.execute(stmt_sub, (bus_id, segment[0])).fetchall()
+            coordinates_list.append(
+                [list(map(float, row[0].split(',')[::-1] if flip_coordinates else row[0].split(','))) for row in coordinates]
+            )
+
+        route = {
+            "type": "Feature",
+            "properties": {
+                "bus_id": bus_id,
+                "name": name,
+                "from": from_station,
+                "to": to_station
+            },
+            "geometry": {
+                "type": "MultiLineString",
+                "coordinates": coordinates_list,
+            }
+        }
+        geo_json['features'].append(route)
+
+    cursor.close()
+    conn.close()
+
+    return geo_json
+
+
+def benchmark_routes(sizes, repeat=5):
+    """
+    Compares the time needed to generate the routes GeoJson with one query per segment (before)
+    and with a single ordered scan (after) for an increasing number of buses, and prints the results.
+    The scan is timed without the result cache of data_api, whose hits would only measure an unpickling.
+
+    Args:
+        sizes (list of int): The numbers of buses, the full fleet is always added at the end.
+        repeat (int, optional): The number of runs, the best one is reported. Defaults to 5.
+
+    Returns:
+        None
+    """
+
+    bus_ids = api.get_all_bus_ids()
+    get_routes_geojson = api.get_routes_geojson.__wrapped__ # Not cached
+
+    print(f"{'buses':>6}  {'before (ms)':>12}  {'after (ms)':>11}  {'speedup':>8}")
+
+    for size in [size for size in sizes if size < len(bus_ids)] + [len(bus_ids)]:
+        subset = bus_ids[:size]
+
+        if get_routes_geojson_per_segment(subset) != get_routes_geojson(subset):
+            raise Exception('The GeoJson of the two implementations differ!')
+
+        before = min(timeit.repeat(lambda: get_routes_geojson_per_segment(subset), number=1, repeat=repeat))
+        after = min(timeit.repeat(lambda: get_routes_geojson(subset), number=1, repeat=repeat))
+
+        print(f"{size:>6}  {before * 1000:>12.1f}  {after * 1000:>11.1f}  {before / after:>7.1f}x")
+
+
+if __name__ == '__main__':
+    benchmark_routes([1, 2, 5, 10, 19, 50, 100])
@@ -0,0 +1,86 @@
+import itertools
+import sqlite3
+
+# Settings of the connection for the rebuild of the tables: the rollback journal is kept in memory and the
+# writes are not synced to disk until the end. A crash during a rebuild can corrupt the db, which must then
+# be rebuilt from scratch, but a full rebuild takes seconds instead of minutes.
+# The journal mode only applies to this connection, except for WAL which is persistent and is therefore kept
+# (leaving it would switch the db out of WAL for the readers too), see BulkLoader.__enter__().
+JOURNAL_PRAGMA = 'PRAGMA journal_mode = MEMORY;'
+REBUILD_PRAGMAS = (
+    'PRAGMA synchronous = OFF;',
+    'PRAGMA temp_store = MEMORY;',
+    'PRAGMA cache_size = -262144;',
+)
+
+
+class BulkLoader:
+    """
+    Writes rows to the db in bulk for the scripts that rebuild its tables. All the statements run in a single
+    transaction, committed when the context manager exits and rolled back on errors, and the rows are inserted
+    with executemany() in batches read from any iterable, so they do not need to be held in memory.
+
+    Args:
+        path (Path): The path of the db.
+        batch_size (int, optional): The number of rows inserted by each executemany(). Defaults to 10000.
+    """
+
+    def __init__(self, path, batch_size=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = sqlite3.connect(self.path, isolation_level=None)
+        if self.conn.execute('PRAGMA journal_mode;').fetchone()[0].lower() != 'wal':
+            self.conn.execute(JOURNAL_PRAGMA)
+        for pragma in REBUILD_PRAGMAS:
+            self.conn.execute(pragma)
+        self.conn.execute('BEGIN;')
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.conn.execute('COMMIT;' if exc_type is None else 'ROLLBACK;')
+        finally:
+            self.conn.close()
+            self.conn = None
+
+    def execute(self, stmt, data=()):
+        """
+        Run a single statement in the transaction, for example a delete or a query.
+
+        Args:
+            stmt (str): The SQL statement.
+            data (tuple, optional): The parameters of the statement. Defaults to ().
+
+        Returns:
+            sqlite3.Cursor: The cursor of the statement.
+        """
+
+        return self.conn.execute(stmt, data)
+
+    def insert(self, stmt, rows):
+        """
+        Insert rows in batches.
+
+        Args:
+            stmt (str): The INSERT statement.
+            rows (iterable): The parameters of each row.
+
+        Returns:
+            int: The number of inserted rows.
+        """
+
+        rows = iter(rows)
+        count = 0
+
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                break
+            self.conn.executemany(stmt, batch)
+            count += len(batch)
+
+        return count
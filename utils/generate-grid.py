@@ -1,26 +1,352 @@
-import sqlite3
+import itertools
 import numpy
-from shapely.geometry import Point, Polygon
 from tqdm import tqdm
 from pathlib import Path
 
+from bulk_loader import BulkLoader
+
 db = Path.cwd().parent / 'data/main.db'
 
 
-def generate_grid(upper_right, lower_left, n):
+def get_axis_indices(values, lower, upper):
+    """
+    Maps coordinates to the cells of one axis of the grid with a floor division, for all of them at once.
+    The cell i is the open interval (lower[i], upper[i]), so like the point-in-polygon test it replaces,
+    a coordinate on the boundary between two cells belongs to none of them. The neighbours of the estimated cell
+    are checked too because the bounds are not exact multiples of the stride, and the first cell that contains
+    the coordinate is kept.
+
+    Args:
+        values (numpy.ndarray): The coordinates along the axis.
+        lower (numpy.ndarray): The lower bound of each cell along the axis, in increasing order.
+        upper (numpy.ndarray): The upper bound of each cell along the axis.
+
+    Returns:
+        numpy.ndarray: The index of the cell along the axis of each coordinate, -1 when it is outside of the grid.
+    """
+
+    values = numpy.asarray(values, dtype=numpy.float64)
+    stride = (upper[-1] - lower[0]) / len(lower)
+
+    with numpy.errstate(invalid='ignore'):
+        estimate = numpy.floor((values - lower[0]) / stride)
+    estimate = numpy.nan_to_num(estimate, nan=-2, posinf=-2, neginf=-2).clip(-2, len(lower) + 1).astype(numpy.int64)
+
+    indices = numpy.full(len(values), -1, dtype=numpy.int64)
+    for offset in (1, 0, -1): # The smallest candidate is checked last so that it has precedence
+        candidates = estimate + offset
+        valid = (candidates >= 0) & (candidates < len(lower))
+        clipped = candidates.clip(0, len(lower) - 1)
+        inside = valid & (lower[clipped] < values) & (values < upper[clipped])
+        indices[inside] = candidates[inside]
+
+    return indices
+
+
+def get_lattice(cursor, level=0):
+    """
+    Reads the cells of a level of the table 'grid_cells', which are a regular lattice of latitudes (x_axis)
+    and longitudes (y_axis).
+
+    Args:
+        cursor (sqlite3.Cursor or BulkLoader): The cursor used to read the cells.
+        level (int, optional): The resolution level. Defaults to 0 (the finest).
+
+    Returns:
+        dict: The 'cell_ids' matrix indexed by (x_axis, y_axis) and the bounds of the cells along each axis
+        ('lat_lower', 'lat_upper', 'lon_lower', 'lon_upper').
+    """
+
+    stmt_cells = 'SELECT id, x_axis, y_axis, lat_min, lon_min, lat_max, lon_max FROM grid_cells WHERE level = ?;'
+    cells = numpy.array(cursor.execute(stmt_cells, (level,)).fetchall(), dtype=numpy.float64).reshape(-1, 7)
+
+    x_axis = cells[:, 1].astype(numpy.int64)
+    y_axis = cells[:, 2].astype(numpy.int64)
+
+    lattice = {'cell_ids': numpy.full((x_axis.max() + 1, y_axis.max() + 1), -1, dtype=numpy.int64)}
+    lattice['cell_ids'][x_axis, y_axis] = cells[:, 0]
+
+    for axis, indices, lower, upper in (('lat', x_axis, cells[:, 3], cells[:, 5]), ('lon', y_axis, cells[:, 4], cells[:, 6])):
+        lattice[f'{axis}_lower'] = numpy.zeros(indices.max() + 1)
+        lattice[f'{axis}_upper'] = numpy.zeros(indices.max() + 1)
+        lattice[f'{axis}_lower'][indices] = lower
+        lattice[f'{axis}_upper'][indices] = upper
+
+    return lattice
+
+
+def get_cell_units(lattice, lat, lon):
+    """
+    Converts coordinates to cell units from the lower left corner of the grid, where the cell (x_axis, y_axis)
+    is the half-open square [x_axis, x_axis + 1) x [y_axis, y_axis + 1). It is used by the rasterization of the
+    routes, which also adds the cells beside the lines and corners it goes through. The stations are mapped with
+    the open cells of get_cell_indices() instead, see generate_grid().
+
+    Args:
+        lattice (dict): The cells of the grid, as returned by get_lattice().
+        lat (numpy.ndarray): The latitudes.
+        lon (numpy.ndarray): The longitudes.
+
+    Returns:
+        tuple: The arrays of the coordinates along the x_axis and the y_axis.
+    """
+
+    lat_amount, lon_amount = lattice['cell_ids'].shape
+    lat_stride = (lattice['lat_upper'][-1] - lattice['lat_lower'][0]) / lat_amount
+    lon_stride = (lattice['lon_upper'][-1] - lattice['lon_lower'][0]) / lon_amount
+
+    return (numpy.asarray(lat, dtype=numpy.float64) - lattice['lat_lower'][0]) / lat_stride, \
+        (numpy.asarray(lon, dtype=numpy.float64) - lattice['lon_lower'][0]) / lon_stride
+
+
+def get_cell_indices(lattice, lat, lon):
+    """
+    Maps coordinates to the indices (x_axis, y_axis) of the cells that contain them, see get_axis_indices().
+    The cells are open, like for Shapely's within: a point on the line between two cells or on the border of
+    the grid gets no cell.
+
+    Args:
+        lattice (dict): The cells of the grid, as returned by get_lattice().
+        lat (numpy.ndarray): The latitudes.
+        lon (numpy.ndarray): The longitudes.
+
+    Returns:
+        tuple: The arrays of the x_axis and y_axis of the cell of each coordinate, -1 for both of them when
+        the coordinate is outside of the grid, on a boundary or missing.
+    """
+
+    lat_indices = get_axis_indices(lat, lattice['lat_lower'], lattice['lat_upper'])
+    lon_indices = get_axis_indices(lon, lattice['lon_lower'], lattice['lon_upper'])
+    inside = (lat_indices >= 0) & (lon_indices >= 0)
+
+    return numpy.where(inside, lat_indices, -1), numpy.where(inside, lon_indices, -1)
+
+
+def get_cell_row(x_axis, y_axis, lat_min, lon_min, lat_max, lon_max, level):
+    """
+    Builds the row of a cell of the table 'grid_cells'.
+
+    Returns:
+        tuple: The values of the columns (x_axis, y_axis, upper_left, upper_right, lower_right, lower_left,
+        lat_min, lon_min, lat_max, lon_max, level).
+    """
+
+    upper_left = ','.join(map(str, [lat_max, lon_min]))
+    upper_right = ','.join(map(str, [lat_max, lon_max]))
+    lower_right = ','.join(map(str, [lat_min, lon_max]))
+    lower_left = ','.join(map(str, [lat_min, lon_min]))
+
+    return (x_axis, y_axis, upper_left, upper_right, lower_right, lower_left,
+            lat_min, lon_min, lat_max, lon_max, level)
+
+
+def get_coarse_cells(lattice, level):
+    """
+    Generates the cells of a coarser level of the grid pyramid from the finest lattice: the cell (x, y) of the
+    level k covers the finest cells (x << k, y << k) to (((x + 1) << k) - 1, ((y + 1) << k) - 1).
+
+    Args:
+        lattice (dict): The finest cells of the grid, as returned by get_lattice().
+        level (int): The level of the cells.
+
+    Yields:
+        tuple: The row of each cell, see get_cell_row().
+    """
+
+    lat_amount, lon_amount = lattice['cell_ids'].shape
+
+    for x_axis in range(lat_amount >> level):
+        for y_axis in range(lon_amount >> level):
+            yield get_cell_row(x_axis, y_axis,
+                               lattice['lat_lower'][x_axis << level], lattice['lon_lower'][y_axis << level],
+                               lattice['lat_upper'][((x_axis + 1) << level) - 1],
+                               lattice['lon_upper'][((y_axis + 1) << level) - 1], level)
+
+
+def get_segment_pairs(bus_ids, segments):
+    """
+    Pairs the consecutive points of the same segment of the routes, the segments with a single point are a pair
+    with itself.
+
+    Args:
+        bus_ids (numpy.ndarray): The bus id of each point, ordered by bus, segment and sequence.
+        segments (numpy.ndarray): The segment of each point.
+
+    Returns:
+        tuple: The indices of the first and of the second point of each pair.
+    """
+
+    if len(bus_ids) == 0: # Without routes there is no pair
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+
+    same = (bus_ids[1:] == bus_ids[:-1]) & (segments[1:] == segments[:-1])
+    single = ~numpy.concatenate([[False], same]) & ~numpy.concatenate([same, [False]])
+    first = numpy.sort(numpy.concatenate([numpy.flatnonzero(same), numpy.flatnonzero(single)]))
+    second = numpy.where(single[first], first, first + 1)
+
+    return first, second
+
+
+def get_crossings(pairs_amount, start, end):
+    """
+    Computes where the segments between consecutive points cross the lines of the grid along one axis.
+    The coordinates are in cell units, so the lines are the integers.
+
+    Args:
+        pairs_amount (int): The number of segments.
+        start (numpy.ndarray): The coordinate of the first point of each segment.
+        end (numpy.ndarray): The coordinate of the second point of each segment.
+
+    Returns:
+        tuple: The segment index and the position along the segment (between 0 and 1) of each crossing,
+        and the direction of each segment along the axis (+1, -1 or 0).
+    """
+
+    first = numpy.floor(start).astype(numpy.int64)
+    last = numpy.floor(end).astype(numpy.int64)
+    steps = numpy.sign(last - first)
+    counts = numpy.abs(last - first)
+
+    pairs = numpy.repeat(numpy.arange(pairs_amount), counts)
+    offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    # Moving up the lines first + 1, ..., last are crossed, moving down the lines first, ..., last + 1
+    lines = numpy.where(steps[pairs] > 0, first[pairs] + 1 + offsets, first[pairs] - offsets)
+    positions = (lines - start[pairs]) / (end[pairs] - start[pairs])
+
+    return pairs, positions, steps
+
+
+def rasterize_routes(lattice, routes):
+    """
+    Finds every cell of the grid crossed by the routes, in the order they are traversed, with a vectorized
+    supercover DDA (Amanatides-Woo) over all the segments between consecutive points at once.
+    The crossings of the lines of the grid are sorted along each segment and each one moves to the next cell
+    along its axis. When a segment goes exactly through a corner of the grid, both cells beside the corner are
+    included (supercover), so no cell touched by a route is missed. The cells are the half-open squares of
+    get_cell_units(), so a route that only ends on a line does not reach the cell beyond it.
+
+    Args:
+        lattice (dict): The cells of the grid, as returned by get_lattice().
+        routes (numpy.ndarray): The points of the routes of shape (points, 4) with the columns
+        (bus_id, segment, lat, lon), ordered by bus, segment and sequence.
+
+    Returns:
+        tuple: The arrays of the bus ids and of the cell indices (x_axis and y_axis) in the order of the traversal,
+        one for each cell crossed by each segment (the same cell can be repeated).
+    """
+
+    bus_ids, segments = routes[:, 0].astype(numpy.int64), routes[:, 1].astype(numpy.int64)
+    lat_amount, lon_amount = lattice['cell_ids'].shape
+
+    u, v = get_cell_units(lattice, routes[:, 2], routes[:, 3])
+
+    first, second = get_segment_pairs(bus_ids, segments)
+    pairs_amount = len(first)
+
+    u_pairs, u_positions, u_steps = get_crossings(pairs_amount, u[first], u[second])
+    v_pairs, v_positions, v_steps = get_crossings(pairs_amount, v[first], v[second])
+
+    # Events sorted along each segment: its start (kind 0), then the crossings along u (kind 1) and v (kind 2)
+    pairs = numpy.concatenate([numpy.arange(pairs_amount), u_pairs, v_pairs])
+    positions = numpy.concatenate([numpy.full(pairs_amount, -1.0), u_positions, v_positions])
+    kinds = numpy.concatenate([numpy.zeros(pairs_amount, dtype=numpy.int64), numpy.ones(len(u_pairs), dtype=numpy.int64),
+                               numpy.full(len(v_pairs), 2, dtype=numpy.int64)])
+    order = numpy.lexsort((kinds, positions, pairs))
+    pairs, positions, kinds = pairs[order], positions[order], kinds[order]
+
+    # The cell after each event is the cell of the start plus the steps taken so far along the segment
+    starts = numpy.flatnonzero(kinds == 0)
+    u_moves = numpy.cumsum(numpy.where(kinds == 1, u_steps[pairs], 0))
+    v_moves = numpy.cumsum(numpy.where(kinds == 2, v_steps[pairs], 0))
+    u_cells = numpy.floor(u[first]).astype(numpy.int64)[pairs] + u_moves - u_moves[starts][pairs]
+    v_cells = numpy.floor(v[first]).astype(numpy.int64)[pairs] + v_moves - v_moves[starts][pairs]
+    event_order = numpy.arange(len(pairs), dtype=numpy.float64)
+
+    # Through a corner the u crossing is followed by the v crossing at the same position, add the other side
+    corners = numpy.flatnonzero((kinds[:-1] == 1) & (kinds[1:] == 2) & (pairs[:-1] == pairs[1:])
+                                & (positions[:-1] == positions[1:]))
+    u_cells = numpy.concatenate([u_cells, u_cells[corners] - u_steps[pairs[corners]]])
+    v_cells = numpy.concatenate([v_cells, v_cells[corners + 1]])
+    pairs = numpy.concatenate([pairs, pairs[corners]])
+    order = numpy.argsort(numpy.concatenate([event_order, corners + 0.5]), kind='stable')
+    u_cells, v_cells, pairs = u_cells[order], v_cells[order], pairs[order]
+
+    inside = (u_cells >= 0) & (u_cells < lat_amount) & (v_cells >= 0) & (v_cells < lon_amount)
+
+    return bus_ids[first][pairs[inside]], u_cells[inside], v_cells[inside]
+
+
+def get_first_visits(bus_ids, cell_ids):
+    """
+    Keeps the first visit of each bus to each cell and numbers the cells of each bus in the order of the visits.
+
+    Args:
+        bus_ids (numpy.ndarray): The bus ids, grouped by bus.
+        cell_ids (numpy.ndarray): The cell ids in the order of the traversal.
+
+    Returns:
+        tuple: The arrays of the bus ids, of the cell ids and of the sequence number (from 1) of each first visit.
+    """
+
+    keys = numpy.stack([bus_ids, cell_ids], axis=1)
+    _, first_visits = numpy.unique(keys, axis=0, return_index=True)
+    first_visits.sort()
+
+    bus_ids, cell_ids = bus_ids[first_visits], cell_ids[first_visits]
+    bus_starts = numpy.flatnonzero(numpy.concatenate([[True], bus_ids[1:] != bus_ids[:-1]]))
+    seq = numpy.arange(len(bus_ids)) - numpy.repeat(bus_starts, numpy.diff(numpy.append(bus_starts, len(bus_ids)))) + 1
+
+    return bus_ids, cell_ids, seq
+
+
+def clear_grid(loader):
+    """
+    Deletes the previous grid with everything that refers to its cells.
+
+    Args:
+        loader (BulkLoader): The loader of the rebuild.
+
+    Returns:
+        None
+    """
+
+    stmt_delete = 'DELETE FROM grid_cells;'
+    loader.execute(stmt_delete)
+    stmt_delete = 'DELETE FROM routes_cells;'
+    loader.execute(stmt_delete)
+    stmt_delete = 'DELETE FROM stations_cells_overpass;'
+    loader.execute(stmt_delete)
+    stmt_delete = 'DELETE FROM stations_cells_here;'
+    loader.execute(stmt_delete)
+    stmt_delete = 'DELETE FROM cells_weights;' # The weights refer to the cells of the previous grid
+    loader.execute(stmt_delete)
+    stmt_delete = 'DELETE FROM cells_frequencies;' # Rebuilt by refresh-frequencies.py
+    loader.execute(stmt_delete)
+
+
+def generate_grid(upper_right, lower_left, n, levels=1):
     """
     Generates the coordinates for the cells in the grid based on the provided number of cells (n), 
     upper right and lower left coordinates and saves them to db in the table 'grid_cells'.
     It also maps the bus routes and the bus stations to the grid cells and saves them in the 
-    table 'routes_cells' and 'stations_cells_*' respectively.
+    table 'routes_cells' and 'stations_cells_*' respectively. The routes are rasterized, so every cell crossed
+    between two consecutive points is included, with 'seq' being the order in which each bus enters the cells.
     Since the stations are linked to 2 (sometimes) different sets of (nearby) coordinates because of the data 
     merge between Overpass and Here, there are 2 table 'stations_cells_overpass' and 'stations_cells_here'.
     They can be both used in get_grid_geojson() of data_api.py.
+    With more than one level, a quadtree-style pyramid of grids is stored side by side in the same tables with
+    a different 'level': the level 0 is the n x n grid, the level k is the (n >> k) x (n >> k) grid whose cells
+    group 2^k x 2^k cells of the level 0. The coarser levels are derived from the level 0 by shifting the indices
+    of its cells, so the routes and the stations are mapped only once. Every function of data_api.py and
+    optimize.py that uses the grid takes the level as a parameter.
+    Run refresh-frequencies.py afterwards to rebuild the departures aggregated per cell.
 
     Args:
         upper_right (list of float): The upper right GPS coordinates of the grid.
         lower_left (list of float): The lower left GPS coordinates of the grid.
-        n (int): The granularity of the grid expressed in total number of cells.
+        n (int): The granularity of the grid expressed in number of cells along each side of the finest level.
+        levels (int, optional): The number of levels of the pyramid, n must be divisible by 2^(levels - 1).
+        Defaults to 1.
     
     Returns:
         None
@@ -29,112 +355,435 @@ def generate_grid(upper_right, lower_left, n):
         https://www.jpytr.com/post/analysinggeographicdatawithfolium/
     """
 
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
+    if n % 2 ** (levels - 1):
+        raise Exception('The number of cells must be divisible by 2 ** (levels - 1)!')
 
-    stmt_delete = 'DELETE FROM grid_cells;'
-    cursor.execute(stmt_delete)
-    stmt_delete = 'DELETE FROM routes_cells;'
-    cursor.execute(stmt_delete)
-    stmt_delete = 'DELETE FROM stations_cells_overpass;'
-    cursor.execute(stmt_delete)
-    stmt_delete = 'DELETE FROM stations_cells_here;'
-    cursor.execute(stmt_delete)
-
-    stmt_insert = """INSERT INTO grid_cells (x_axis, y_axis, upper_left, upper_right, lower_right, lower_left) 
-        VALUES (?, ?, ?, ?, ?, ?);"""
-
-    lat_steps = numpy.linspace(lower_left[0], upper_right[0], n + 1)
-    lon_steps = numpy.linspace(lower_left[1], upper_right[1], n + 1)
-
-    lat_stride = lat_steps[1] - lat_steps[0]
-    lon_stride = lon_steps[1] - lon_steps[0]
-
-    for lat_index, lat in enumerate(lat_steps[:-1]):
-        for lon_index, lon in enumerate(lon_steps[:-1]):
-            upper_left = ','.join(map(str, [lat + lat_stride, lon]))
-            upper_right = ','.join(map(str, [lat + lat_stride, lon + lon_stride]))
-            lower_right = ','.join(map(str, [lat, lon + lon_stride]))
-            lower_left = ','.join(map(str, [lat, lon]))
-
-            data = (lat_index, lon_index, upper_left, upper_right, lower_right, lower_left)
-            cursor.execute(stmt_insert, data)
-
-    stmt_routes = 'SELECT bus_id, coordinates FROM routes_points ORDER BY bus_id, segment AND seq;'
-    routes = cursor.execute(stmt_routes).fetchall()
-
-    stmt_cells = 'SELECT id, upper_left, upper_right, lower_right, lower_left FROM grid_cells;'
-    cells = cursor.execute(stmt_cells).fetchall()
-
-    stmt_check = 'SELECT count(*) FROM routes_cells WHERE bus_id = ? AND cell_id = ?;'
-    stmt_insert = 'INSERT INTO routes_cells (bus_id, cell_id, seq) VALUES (?, ?, ?);'
-
-    for point in enumerate(tqdm(routes)):
-        for cell in cells:
-            point_obj = Point(map(float, point[1].split(',')))
-            poly_obj = Polygon(map(list, [
-                map(float, cell[1].split(',')), 
-                map(float, cell[2].split(',')), 
-                map(float, cell[3].split(',')), 
-                map(float, cell[4].split(','))
-            ]))
-            
-            if point_obj.within(poly_obj):
-                data = (point[0], cell[0])
-                counter = cursor.execute(stmt_check, data).fetchone()[0]
-                if counter == 0:
-                    # index += 1
-                    data = (point[0], cell[0], 1) # sets seq = 1 because the order of segments is wrong anyway
-                    cursor.execute(stmt_insert, data)
-                break
-
-    stmt_stations_overpass = 'SELECT id, coordinates_overpass FROM stations WHERE no_data = 0 AND duplicate = 0;'
-    stations_overpass = cursor.execute(stmt_stations_overpass).fetchall()
-
-    stmt_insert_overpass = 'INSERT INTO stations_cells_overpass (station_id, cell_id) VALUES (?, ?);'
-
-    for station in tqdm(stations_overpass):
-        for cell in cells:
-            point_obj = Point(map(float, station[1].split(',')))
-            poly_obj = Polygon(map(list, [
-                map(float, cell[1].split(',')), 
-                map(float, cell[2].split(',')), 
-                map(float, cell[3].split(',')), 
-                map(float, cell[4].split(','))
-            ]))
-
-            if point_obj.within(poly_obj):
-                data = (station[0], cell[0])
-                cursor.execute(stmt_insert_overpass, data)
-                break
-
-    stmt_stations_here = 'SELECT id, coordinates_here FROM stations WHERE no_data = 0 AND duplicate = 0;'
-    stations_here = cursor.execute(stmt_stations_here).fetchall()
-
-    stmt_insert_here = 'INSERT INTO stations_cells_here (station_id, cell_id) VALUES (?, ?);'
-
-    for station in tqdm(stations_here):
-        for cell in cells:
-            point_obj = Point(map(float, station[1].split(',')))
-            poly_obj = Polygon(map(list, [
-                map(float, cell[1].split(',')), 
-                map(float, cell[2].split(',')), 
-                map(float, cell[3].split(',')), 
-                map(float, cell[4].split(','))
-            ]))
-
-            if point_obj.within(poly_obj):
-                data = (station[0], cell[0])
-                cursor.execute(stmt_insert_here, data)
-                break
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with BulkLoader(db) as loader:
+        clear_grid(loader)
+
+        stmt_insert = """INSERT INTO grid_cells (x_axis, y_axis, upper_left, upper_right, lower_right, lower_left, 
+            lat_min, lon_min, lat_max, lon_max, level) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"""
+
+        lat_steps = numpy.linspace(lower_left[0], upper_right[0], n + 1)
+        lon_steps = numpy.linspace(lower_left[1], upper_right[1], n + 1)
+
+        lat_stride = lat_steps[1] - lat_steps[0]
+        lon_stride = lon_steps[1] - lon_steps[0]
+
+        def cells():
+            for lat_index, lat in enumerate(lat_steps[:-1]):
+                for lon_index, lon in enumerate(lon_steps[:-1]):
+                    yield get_cell_row(lat_index, lon_index, lat, lon, lat + lat_stride, lon + lon_stride, 0)
+
+        loader.insert(stmt_insert, cells())
+        lattice = get_lattice(loader)
+
+        for level in range(1, levels):
+            loader.insert(stmt_insert, get_coarse_cells(lattice, level))
+
+        lattices = [lattice] + [get_lattice(loader, level) for level in range(1, levels)]
+
+        # The routes are rasterized only on the finest level, the indices of the coarser cells are shifted from it
+        stmt_routes = 'SELECT bus_id, segment, lat, lon FROM routes_points ORDER BY bus_id, segment, seq;'
+        routes = numpy.array(loader.execute(stmt_routes).fetchall(), dtype=numpy.float64).reshape(-1, 4)
+        routes_bus_ids, routes_x, routes_y = rasterize_routes(lattice, routes)
+
+        stmt_insert = 'INSERT INTO routes_cells (bus_id, cell_id, seq, level) VALUES (?, ?, ?, ?);'
+
+        for level, level_lattice in enumerate(lattices):
+            routes_cells = get_first_visits(routes_bus_ids, level_lattice['cell_ids'][routes_x >> level, routes_y >> level])
+            loader.insert(stmt_insert, tqdm(zip(*(column.tolist() for column in routes_cells), itertools.repeat(level)),
+                                            total=len(routes_cells[0])))
+
+        for stations_source in ('overpass', 'here'):
+            stmt_stations = f"""SELECT id, lat_{stations_source}, lon_{stations_source} FROM stations 
+                WHERE no_data = 0 AND duplicate = 0;"""
+            stations = numpy.array(loader.execute(stmt_stations).fetchall(), dtype=numpy.float64).reshape(-1, 3)
+            stations_x, stations_y = get_cell_indices(lattice, stations[:, 1], stations[:, 2])
+            inside = stations_x >= 0
+            station_ids = stations[inside, 0].astype(numpy.int64).tolist()
+
+            stmt_insert = f'INSERT INTO stations_cells_{stations_source} (station_id, cell_id, level) VALUES (?, ?, ?);'
+
+            for level, level_lattice in enumerate(lattices):
+                stations_cells = level_lattice['cell_ids'][stations_x[inside] >> level, stations_y[inside] >> level]
+                loader.insert(stmt_insert, zip(station_ids, stations_cells.tolist(), itertools.repeat(level)))
+
+
+# Hexagonal grid, an alternative to the lat/lon cells of generate_grid() with equal areas and neighbour distances.
+# The hexagons are pointy-top, with axial coordinates (q, r) in a local equirectangular projection in meters,
+# see https://www.redblobgames.com/grids/hexagons/
+
+EARTH_RADIUS = 6371008.8 # The mean radius in meters
+HEX_DIRECTIONS = numpy.array([[1, 0], [1, -1], [0, -1], [-1, 0], [-1, 1], [0, 1]]) # The axial offsets of the neighbours
+HEX_NORMALS = numpy.array([[numpy.cos(angle), numpy.sin(angle)] for angle in numpy.radians([0, 60, 120])]) # Of the edges
+
+
+def get_projection(upper_right, lower_left):
+    """
+    Builds the local equirectangular projection centered on the grid, where the distances are in meters.
+    Over the few kilometers of a city its distortion is negligible, unlike the one of the lat/lon degrees.
+
+    Args:
+        upper_right (list of float): The upper right GPS coordinates of the grid.
+        lower_left (list of float): The lower left GPS coordinates of the grid.
+
+    Returns:
+        dict: The origin ('lat', 'lon') and the meters per degree along each axis ('x_scale', 'y_scale').
+    """
+
+    lat = (upper_right[0] + lower_left[0]) / 2
+    lon = (upper_right[1] + lower_left[1]) / 2
+    y_scale = numpy.pi / 180 * EARTH_RADIUS
+
+    return {'lat': lat, 'lon': lon, 'x_scale': y_scale * numpy.cos(numpy.radians(lat)), 'y_scale': y_scale}
+
+
+def project(projection, lat, lon):
+    """
+    Projects coordinates to meters east (x) and north (y) of the origin of the projection.
+
+    Returns:
+        tuple: The x and y of the coordinates.
+    """
+
+    return (numpy.asarray(lon) - projection['lon']) * projection['x_scale'], \
+        (numpy.asarray(lat) - projection['lat']) * projection['y_scale']
+
+
+def unproject(projection, x, y):
+    """
+    The inverse of project().
+
+    Returns:
+        tuple: The latitudes and the longitudes.
+    """
+
+    return projection['lat'] + numpy.asarray(y) / projection['y_scale'], \
+        projection['lon'] + numpy.asarray(x) / projection['x_scale']
+
+
+def get_hex_centers(size, q, r):
+    """
+    Computes the centers of hexagons.
+
+    Args:
+        size (float): The radius of the hexagons (center to corner) in meters.
+        q (numpy.ndarray): The axial q coordinates.
+        r (numpy.ndarray): The axial r coordinates.
+
+    Returns:
+        tuple: The x and y of the centers.
+    """
+
+    return size * numpy.sqrt(3) * (q + r / 2), size * 1.5 * r
+
+
+def round_hex(size, x, y):
+    """
+    Finds the hexagons that contain points in O(1) each and for all of them at once, by converting them to
+    fractional cube coordinates and rounding the two components with the smallest error.
+
+    Args:
+        size (float): The radius of the hexagons (center to corner) in meters.
+        x (numpy.ndarray): The projected x of the points.
+        y (numpy.ndarray): The projected y of the points.
+
+    Returns:
+        tuple: The axial coordinates (q, r) of the hexagon of each point.
+    """
+
+    q = (numpy.sqrt(3) / 3 * x - y / 3) / size
+    r = 2 / 3 * y / size
+    s = -q - r
+
+    q_round, r_round, s_round = numpy.rint(q), numpy.rint(r), numpy.rint(s)
+    q_error, r_error, s_error = numpy.abs(q_round - q), numpy.abs(r_round - r), numpy.abs(s_round - s)
+
+    fix_q = (q_error > r_error) & (q_error > s_error)
+    fix_r = ~fix_q & (r_error > s_error)
+    q_round = numpy.where(fix_q, -r_round - s_round, q_round)
+    r_round = numpy.where(fix_r, -q_round - s_round, r_round)
+
+    return q_round.astype(numpy.int64), r_round.astype(numpy.int64)
+
+
+def get_hex_neighbors(q, r):
+    """
+    Finds the 6 neighbours of hexagons, which are all at the same distance from them.
+
+    Args:
+        q (numpy.ndarray): The axial q coordinates.
+        r (numpy.ndarray): The axial r coordinates.
+
+    Returns:
+        tuple: The axial coordinates (q, r) of the neighbours, of shape (hexagons, 6).
+    """
+
+    return q[:, None] + HEX_DIRECTIONS[:, 0], r[:, None] + HEX_DIRECTIONS[:, 1]
+
+
+def get_hexagons(projection, size, upper_right, lower_left):
+    """
+    Finds the hexagons that overlap the rectangle of the grid, with the separating axis theorem.
+
+    Args:
+        projection (dict): The projection, as returned by get_projection().
+        size (float): The radius of the hexagons (center to corner) in meters.
+        upper_right (list of float): The upper right GPS coordinates of the grid.
+        lower_left (list of float): The lower left GPS coordinates of the grid.
+
+    Returns:
+        tuple: The axial coordinates (q, r) of the hexagons.
+    """
+
+    x_min, y_min = project(projection, lower_left[0], lower_left[1])
+    x_max, y_max = project(projection, upper_right[0], upper_right[1])
+    corners = numpy.array([[x_min, y_min], [x_min, y_max], [x_max, y_max], [x_max, y_min]])
+
+    # The hexagons around the corners bound the candidates
+    q_corners = (numpy.sqrt(3) / 3 * corners[:, 0] - corners[:, 1] / 3) / size
+    r_corners = 2 / 3 * corners[:, 1] / size
+    q, r = numpy.meshgrid(numpy.arange(numpy.floor(q_corners.min()) - 1, numpy.ceil(q_corners.max()) + 2),
+                          numpy.arange(numpy.floor(r_corners.min()) - 1, numpy.ceil(r_corners.max()) + 2), indexing='ij')
+    q, r = q.ravel().astype(numpy.int64), r.ravel().astype(numpy.int64)
+    centers = numpy.stack(get_hex_centers(size, q, r), axis=1)
+
+    inradius = size * numpy.sqrt(3) / 2
+    overlap = (centers[:, 1] + size > y_min) & (centers[:, 1] - size < y_max)
+    for normal in HEX_NORMALS: # The first normal is the x axis, the normal of the other side of the rectangle
+        center_projections = centers @ normal
+        corner_projections = corners @ normal
+        overlap &= (center_projections + inradius > corner_projections.min()) \
+            & (center_projections - inradius < corner_projections.max())
+
+    return q[overlap], r[overlap]
+
+
+def get_hex_rows(projection, size, q, r, level):
+    """
+    Builds the rows of hexagons for the table 'grid_cells'. The x_axis and y_axis are their axial coordinates
+    shifted to start from 0, the corners are the bounding box and the column 'corners' holds the 6 corners
+    as little-endian float64 (lat, lon) pairs.
+
+    Args:
+        projection (dict): The projection, as returned by get_projection().
+        size (float): The radius of the hexagons (center to corner) in meters.
+        q (numpy.ndarray): The axial q coordinates.
+        r (numpy.ndarray): The axial r coordinates.
+        level (int): The level of the cells.
+
+    Yields:
+        tuple: The row of each cell, see get_cell_row(), followed by its packed corners.
+    """
+
+    centers_x, centers_y = get_hex_centers(size, q, r)
+    angles = numpy.radians(90 - 60 * numpy.arange(6)) # From the top corner, clockwise
+    lat, lon = unproject(projection, centers_x[:, None] + size * numpy.cos(angles),
+                         centers_y[:, None] + size * numpy.sin(angles))
+
+    corners = numpy.stack([lat, lon], axis=-1).astype('<f8')
+
+    for index, (x_axis, y_axis) in enumerate(zip((q - q.min()).tolist(), (r - r.min()).tolist())):
+        yield get_cell_row(x_axis, y_axis, lat[index].min(), lon[index].min(), lat[index].max(), lon[index].max(),
+                           level) + (corners[index].tobytes(),)
+
+
+def get_hex_lattice(cursor, level, projection, size, q_min, r_min):
+    """
+    Reads the hexagons of a level of the table 'grid_cells'.
+
+    Args:
+        cursor (sqlite3.Cursor or BulkLoader): The cursor used to read the cells.
+        level (int): The level of the cells.
+        projection (dict): The projection, as returned by get_projection().
+        size (float): The radius of the hexagons (center to corner) in meters.
+        q_min (int): The axial q coordinate of the x_axis 0.
+        r_min (int): The axial r coordinate of the y_axis 0.
+
+    Returns:
+        dict: The 'cell_ids' matrix indexed by (x_axis, y_axis) together with the arguments.
+    """
+
+    stmt_cells = 'SELECT id, x_axis, y_axis FROM grid_cells WHERE level = ?;'
+    cells = numpy.array(cursor.execute(stmt_cells, (level,)).fetchall(), dtype=numpy.int64).reshape(-1, 3)
+
+    cell_ids = numpy.full((cells[:, 1].max() + 1, cells[:, 2].max() + 1), -1, dtype=numpy.int64)
+    cell_ids[cells[:, 1], cells[:, 2]] = cells[:, 0]
+
+    return {'cell_ids': cell_ids, 'projection': projection, 'size': size, 'q_min': q_min, 'r_min': r_min}
+
+
+def get_hex_indices(lattice, q, r):
+    """
+    Maps axial coordinates to the indices (x_axis, y_axis) of the cells of the grid.
+
+    Args:
+        lattice (dict): The hexagons of the grid, as returned by get_hex_lattice().
+        q (numpy.ndarray): The axial q coordinates.
+        r (numpy.ndarray): The axial r coordinates.
+
+    Returns:
+        tuple: The arrays of the x_axis and y_axis of each hexagon, -1 for both of them when it is not in the grid.
+    """
+
+    x_axis, y_axis = q - lattice['q_min'], r - lattice['r_min']
+    x_amount, y_amount = lattice['cell_ids'].shape
+
+    inside = (x_axis >= 0) & (x_axis < x_amount) & (y_axis >= 0) & (y_axis < y_amount)
+    inside[inside] = lattice['cell_ids'][x_axis[inside], y_axis[inside]] >= 0
+
+    return numpy.where(inside, x_axis, -1), numpy.where(inside, y_axis, -1)
+
+
+def get_hex_cell_indices(lattice, lat, lon):
+    """
+    Maps coordinates to the indices (x_axis, y_axis) of the hexagons that contain them, see round_hex().
+
+    Args:
+        lattice (dict): The hexagons of the grid, as returned by get_hex_lattice().
+        lat (numpy.ndarray): The latitudes.
+        lon (numpy.ndarray): The longitudes.
+
+    Returns:
+        tuple: The arrays of the x_axis and y_axis of the cell of each coordinate, -1 for both of them when
+        the coordinate is outside of the grid.
+    """
+
+    x, y = project(lattice['projection'], lat, lon)
+    valid = numpy.isfinite(x) & numpy.isfinite(y) # The missing coordinates are NaN
+    q, r = round_hex(lattice['size'], numpy.where(valid, x, 0), numpy.where(valid, y, 0))
+    x_axis, y_axis = get_hex_indices(lattice, q, r)
+
+    return numpy.where(valid, x_axis, -1), numpy.where(valid, y_axis, -1)
+
+
+def rasterize_hex_routes(lattice, routes):
+    """
+    Finds every hexagon of the grid crossed by the routes, in the order they are traversed, for all the segments
+    between consecutive points at once. Each segment is sampled at most one radius apart, so every hexagon it
+    crosses is the hexagon of a sample or one of its neighbours. The segment is then clipped against each of
+    these candidates (Cyrus-Beck), which keeps the hexagons it touches, even at a corner, ordered by where
+    it enters them.
+
+    Args:
+        lattice (dict): The hexagons of the grid, as returned by get_hex_lattice().
+        routes (numpy.ndarray): The points of the routes of shape (points, 4) with the columns
+        (bus_id, segment, lat, lon), ordered by bus, segment and sequence.
+
+    Returns:
+        tuple: The arrays of the bus ids and of the cell indices (x_axis and y_axis) in the order of the traversal,
+        one for each cell crossed by each segment (the same cell can be repeated).
+    """
+
+    bus_ids, segments = routes[:, 0].astype(numpy.int64), routes[:, 1].astype(numpy.int64)
+    size = lattice['size']
+
+    points = numpy.stack(project(lattice['projection'], routes[:, 2], routes[:, 3]), axis=1)
+    first, second = get_segment_pairs(bus_ids, segments)
+    starts, directions = points[first], points[second] - points[first]
+
+    counts = numpy.floor(numpy.hypot(directions[:, 0], directions[:, 1]) / size).astype(numpy.int64) + 2
+    pairs = numpy.repeat(numpy.arange(len(first)), counts)
+    offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    samples = starts[pairs] + (offsets / (counts[pairs] - 1))[:, None] * directions[pairs]
+
+    q, r = round_hex(size, samples[:, 0], samples[:, 1])
+    q_neighbors, r_neighbors = get_hex_neighbors(q, r)
+    candidates = numpy.stack([numpy.repeat(pairs, 7), numpy.column_stack([q, q_neighbors]).ravel(),
+                              numpy.column_stack([r, r_neighbors]).ravel()], axis=1)
+    pairs, q, r = numpy.unique(candidates, axis=0).T
+
+    # Each hexagon is the intersection of 3 slabs |normal . (point - center)| <= inradius
+    inradius = size * numpy.sqrt(3) / 2
+    centers = numpy.stack(get_hex_centers(size, q, r), axis=1)
+    distances = (starts[pairs] - centers) @ HEX_NORMALS.T
+    speeds = directions[pairs] @ HEX_NORMALS.T
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        bounds = numpy.stack([(-inradius - distances) / speeds, (inradius - distances) / speeds])
+    parallel = speeds == 0 # Inside the slab for the whole segment or never
+    inside_slab = numpy.abs(distances) <= inradius
+    lower = numpy.where(parallel, numpy.where(inside_slab, -numpy.inf, numpy.inf), bounds.min(axis=0))
+    upper = numpy.where(parallel, numpy.where(inside_slab, numpy.inf, -numpy.inf), bounds.max(axis=0))
+    enter = numpy.maximum(lower.max(axis=1), 0)
+    leave = numpy.minimum(upper.min(axis=1), 1)
+
+    crossed = enter <= leave
+    order = numpy.lexsort((leave[crossed], enter[crossed], pairs[crossed]))
+    pairs, q, r = pairs[crossed][order], q[crossed][order], r[crossed][order]
+
+    x_axis, y_axis = get_hex_indices(lattice, q, r)
+    inside = x_axis >= 0
+
+    return bus_ids[first][pairs[inside]], x_axis[inside], y_axis[inside]
+
+
+def generate_hex_grid(upper_right, lower_left, size, levels=1):
+    """
+    Generates a grid of hexagons instead of lat/lon cells, see generate_grid(). The lat/lon cells are distorted
+    at the latitude of Copenhagen and their neighbours are at different distances, while the hexagons are
+    built in meters and all 6 neighbours of a hexagon are at the same distance.
+    The hexagons are saved in the same tables as the lat/lon cells, with their corners in the column 'corners'
+    of 'grid_cells', so data_api.py and optimize.py use them unchanged. Every hexagon that overlaps the rectangle
+    between the two coordinates is included.
+    The hexagons of different sizes do not nest, so each level of the pyramid doubles the size of the previous
+    one and is mapped on its own.
+    Run refresh-frequencies.py afterwards to rebuild the departures aggregated per cell.
+
+    Args:
+        upper_right (list of float): The upper right GPS coordinates of the grid.
+        lower_left (list of float): The lower left GPS coordinates of the grid.
+        size (float): The radius of the hexagons (center to corner) of the finest level in meters.
+        levels (int, optional): The number of levels of the pyramid. Defaults to 1.
+
+    Returns:
+        None
+    """
+
+    projection = get_projection(upper_right, lower_left)
+
+    with BulkLoader(db) as loader:
+        clear_grid(loader)
+
+        stmt_routes = 'SELECT bus_id, segment, lat, lon FROM routes_points ORDER BY bus_id, segment, seq;'
+        routes = numpy.array(loader.execute(stmt_routes).fetchall(), dtype=numpy.float64).reshape(-1, 4)
+
+        stations = {}
+        for stations_source in ('overpass', 'here'):
+            stmt_stations = f"""SELECT id, lat_{stations_source}, lon_{stations_source} FROM stations 
+                WHERE no_data = 0 AND duplicate = 0;"""
+            stations[stations_source] = numpy.array(loader.execute(stmt_stations).fetchall(),
+                                                    dtype=numpy.float64).reshape(-1, 3)
+
+        for level in range(levels):
+            level_size = size * 2 ** level
+            q, r = get_hexagons(projection, level_size, upper_right, lower_left)
+
+            stmt_insert = """INSERT INTO grid_cells (x_axis, y_axis, upper_left, upper_right, lower_right, lower_left, 
+                lat_min, lon_min, lat_max, lon_max, level, corners) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"""
+            loader.insert(stmt_insert, get_hex_rows(projection, level_size, q, r, level))
+            lattice = get_hex_lattice(loader, level, projection, level_size, q.min(), r.min())
+
+            routes_bus_ids, routes_x, routes_y = rasterize_hex_routes(lattice, routes)
+            routes_cells = get_first_visits(routes_bus_ids, lattice['cell_ids'][routes_x, routes_y])
+
+            stmt_insert = 'INSERT INTO routes_cells (bus_id, cell_id, seq, level) VALUES (?, ?, ?, ?);'
+            loader.insert(stmt_insert, tqdm(zip(*(column.tolist() for column in routes_cells), itertools.repeat(level)),
+                                            total=len(routes_cells[0])))
+
+            for stations_source, source_stations in stations.items():
+                stations_x, stations_y = get_hex_cell_indices(lattice, source_stations[:, 1], source_stations[:, 2])
+                inside = stations_x >= 0
+                stations_cells = lattice['cell_ids'][stations_x[inside], stations_y[inside]]
+
+                stmt_insert = f'INSERT INTO stations_cells_{stations_source} (station_id, cell_id, level) VALUES (?, ?, ?);'
+                loader.insert(stmt_insert, zip(source_stations[inside, 0].astype(numpy.int64).tolist(),
+                                               stations_cells.tolist(), itertools.repeat(level)))
 
 
 if __name__ == '__main__':
     upper_right = [55.716668, 12.583234]
     lower_left = [55.642439, 12.501228]
     n = 10
-    generate_grid(upper_right, lower_left, n)
+    generate_grid(upper_right, lower_left, n) # Or generate_hex_grid(upper_right, lower_left, size) with size in meters
@@ -1,8 +1,9 @@
 import geojson
 from tqdm import tqdm
-import sqlite3
 from pathlib import Path
 
+from bulk_loader import BulkLoader
+
 db = Path.cwd().parent / 'data/main.db'
 
 
@@ -10,6 +11,7 @@ def get_routes():
     """
     Extracts the buses and routes from bus-routes.geojson and saves them 
     to the db in the tables 'buses' and 'routes_points'.
+    Run simplify-routes.py afterwards to rebuild the simplified routes.
 
     Args:
         None
@@ -18,14 +20,6 @@ def get_routes():
         None
     """
 
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    stmt_delete = 'DELETE FROM buses;'
-    cursor.execute(stmt_delete)
-    stmt_delete = 'DELETE FROM routes_points;'
-    cursor.execute(stmt_delete)
-    
     with open('../data/bus-routes.geojson', 'r') as f:
         gj = geojson.load(f)
 
@@ -64,24 +58,31 @@ def get_routes():
                 bus['route'].append(segment)
         buses.append(bus)
 
-    stmt_buses = """INSERT INTO buses (name, from_station_name, to_station_name)
-            VALUES (?, ?, ?);"""
-
-    stmt_routes = """INSERT INTO routes_points (bus_id, segment, coordinates, seq)
+    stmt_buses = """INSERT INTO buses (id, name, from_station_name, to_station_name)
             VALUES (?, ?, ?, ?);"""
 
-    for bus in tqdm(buses):
-        data = (bus['name'], bus['from'], bus['to'])
-        cursor.execute(stmt_buses, data)
-        bus_id = cursor.lastrowid
-        for segment_index, segment in enumerate(bus['route']):
-            for point_index, point in enumerate(segment):
-                data = (bus_id, segment_index+1, ','.join(map(str, point)), point_index+1)
-                cursor.execute(stmt_routes, data)
+    stmt_routes = """INSERT INTO routes_points (bus_id, segment, coordinates, seq, lat, lon)
+            VALUES (?, ?, ?, ?, ?, ?);"""
+
+    # The tables are emptied first, so the ids assigned by SQLite would be 1, 2, ... in the order of the buses
+    def points():
+        for bus_id, bus in enumerate(tqdm(buses), start=1):
+            for segment_index, segment in enumerate(bus['route']):
+                for point_index, point in enumerate(segment):
+                    yield (bus_id, segment_index+1, ','.join(map(str, point)), point_index+1, point[0], point[1])
+
+    with BulkLoader(db) as loader:
+        stmt_delete = 'DELETE FROM buses;'
+        loader.execute(stmt_delete)
+        stmt_delete = 'DELETE FROM routes_points;'
+        loader.execute(stmt_delete)
+        stmt_delete = 'DELETE FROM routes_points_lod;' # Rebuilt by simplify-routes.py
+        loader.execute(stmt_delete)
+        stmt_delete = 'DELETE FROM routes_lod_levels;'
+        loader.execute(stmt_delete)
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+        loader.insert(stmt_buses, ((bus_id, bus['name'], bus['from'], bus['to']) for bus_id, bus in enumerate(buses, start=1)))
+        loader.insert(stmt_routes, points())
 
 
 if __name__ == '__main__':
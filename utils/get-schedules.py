@@ -19,6 +19,7 @@ def get_schedules(dates, token):
     in the table 'departures'. It ignores the buses that are not in the 'buses' table and it updates 
     some fields in the 'stations' table. This data can be further linked to each bus in order to get their 
     estimated location based on time.
+    Run refresh-frequencies.py afterwards to rebuild the departures aggregated per cell.
 
     Args:
         dates (dict): Dictionary with the dates the data is fetched for (see at the bottom).
@@ -36,6 +37,8 @@ def get_schedules(dates, token):
 
     stmt_delete = 'DELETE FROM departures;'
     cursor.execute(stmt_delete) # Remove this in case of re-execution due to error or sudden termination
+    stmt_delete = 'DELETE FROM cells_frequencies;' # Stale until refresh-frequencies.py is run
+    cursor.execute(stmt_delete)
 
     headers = {'Authorization': 'Bearer ' + token}
     params = {'maxPlaces': 1, 'modes': 'bus', 'maxPerBoard': 50}
@@ -43,7 +46,7 @@ def get_schedules(dates, token):
 
     stmt_stations = 'SELECT id, coordinates_overpass FROM stations ORDER BY id;'
     stmt_station_update = """UPDATE stations SET id_here = ?, name_here = ?, coordinates_here = ?, 
-                            no_data = 0, duplicate = 0 WHERE id = ?;"""
+                            lat_here = ?, lon_here = ?, no_data = 0, duplicate = 0 WHERE id = ?;"""
     stmt_departures = """INSERT INTO departures (station_id, bus, headsign, day, time)
                         VALUES (?, ?, ?, ?, ?);"""
     stmt_station_check_stream = 'SELECT id_here FROM stations WHERE id = ?;'
@@ -92,7 +95,8 @@ def get_schedules(dates, token):
                         cursor.execute(stmt_station_set_duplicate, (station[0],))
                         break
                     
-                    station_data = (data['place']['id'], data['place']['name'], coordinates_here, station[0])
+                    station_data = (data['place']['id'], data['place']['name'], coordinates_here,
+                                    data['place']['location']['lat'], data['place']['location']['lng'], station[0])
                     cursor.execute(stmt_station_update, station_data)
             
                 elif id_here != data['place']['id']:
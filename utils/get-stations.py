@@ -1,8 +1,9 @@
-import sqlite3
 import geojson
 from tqdm import tqdm
 from pathlib import Path
 
+from bulk_loader import BulkLoader
+
 db = Path.cwd().parent / 'data/main.db'
 
 
@@ -17,29 +18,26 @@ def get_stations():
         None
     """
 
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    stmt_delete = 'DELETE FROM stations;'
-    cursor.execute(stmt_delete)
-
-    stmt_insert = """INSERT INTO stations (id_overpass, name_overpass, coordinates_overpass)
-            VALUES (?, ?, ?);"""
+    stmt_insert = """INSERT INTO stations (id_overpass, name_overpass, coordinates_overpass, lat_overpass, lon_overpass)
+            VALUES (?, ?, ?, ?, ?);"""
 
     with open('../data/bus-stations.geojson', 'r') as f:
         gj = geojson.load(f)
 
-    for item in tqdm(gj['features']):
-        try:
-            name = item['properties']['name']
-        except:
-            name = None
-        data = (item['id'], name, ','.join(map(str, item['geometry']['coordinates'][::-1])))
-        cursor.execute(stmt_insert, data)
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+    def stations():
+        for item in tqdm(gj['features']):
+            try:
+                name = item['properties']['name']
+            except:
+                name = None
+            lon, lat = item['geometry']['coordinates'][:2]
+            yield (item['id'], name, ','.join(map(str, item['geometry']['coordinates'][::-1])), lat, lon)
+
+    with BulkLoader(db) as loader:
+        stmt_delete = 'DELETE FROM stations;'
+        loader.execute(stmt_delete)
+
+        loader.insert(stmt_insert, stations())
 
 
 if __name__ == '__main__':
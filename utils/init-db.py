@@ -1,12 +1,15 @@
 import sqlite3
 from pathlib import Path
 
+from migrations import migrate_db
+
 db = Path.cwd().parent / 'data/main.db'
 
 
 def init_db():
     """
-    Creates the needed tables in the sqlite db main.db.
+    Creates the needed tables in the sqlite db main.db, then applies the migrations in migrations.py
+    to add the numeric coordinates and create the indexes. Existing dbs can be upgraded by running migrations.py instead.
 
     Args:
         None
@@ -94,8 +97,31 @@ def init_db():
 
     cursor.execute(stmt_create)
 
+    stmt_drop = 'DROP TABLE IF EXISTS cells_weights;'
+    cursor.execute(stmt_drop)
+
+    stmt_create = """CREATE TABLE cells_weights (cell_id INTEGER PRIMARY KEY, weight REAL NOT NULL,
+            FOREIGN KEY(cell_id) REFERENCES grid_cells(id));"""
+
+    cursor.execute(stmt_create)
+
+    stmt_drop = 'DROP TABLE IF EXISTS cells_frequencies;'
+    cursor.execute(stmt_drop)
+
+    # Number of departures per stations source, day type, hour, cell and bus, see refresh-frequencies.py
+    # The departures of the buses that are not in the table 'buses' have no bus_id and are counted in the totals only
+    stmt_create = """CREATE TABLE cells_frequencies (id INTEGER PRIMARY KEY, stations_source TEXT NOT NULL, 
+            day TEXT NOT NULL, hour TEXT NOT NULL, cell_id INTEGER NOT NULL, bus_id INTEGER, 
+            count INTEGER NOT NULL, FOREIGN KEY(cell_id) REFERENCES grid_cells(id),
+            FOREIGN KEY(bus_id) REFERENCES buses(id));"""
+
+    cursor.execute(stmt_create)
+
     conn.commit()
     cursor.close()
+
+    conn.execute('PRAGMA user_version = 0;') # The tables were just recreated with the first schema
+    migrate_db(conn)
     conn.close()
 
 
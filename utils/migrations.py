@@ -0,0 +1,203 @@
+import sqlite3
+import numpy
+from pathlib import Path
+
+db = Path.cwd().parent / 'data/main.db'
+
+
+def split_coordinates(conn):
+    """
+    Fills the numeric latitude and longitude columns of the coordinates stored as 'lat,lon' text.
+    The grid cells are axis-aligned, so their corners are stored as the min and max latitude and longitude.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the db.
+
+    Returns:
+        None
+    """
+
+    def split(coordinates):
+        return tuple(map(float, coordinates.split(','))) if coordinates is not None else (None, None)
+
+    points = conn.execute('SELECT id, coordinates FROM routes_points;').fetchall()
+    conn.executemany('UPDATE routes_points SET lat = ?, lon = ? WHERE id = ?;',
+                     [(*split(coordinates), point_id) for point_id, coordinates in points])
+
+    stations = conn.execute('SELECT id, coordinates_overpass, coordinates_here FROM stations;').fetchall()
+    conn.executemany("""UPDATE stations SET lat_overpass = ?, lon_overpass = ?, lat_here = ?, lon_here = ? 
+                     WHERE id = ?;""",
+                     [(*split(overpass), *split(here), station_id) for station_id, overpass, here in stations])
+
+    cells = conn.execute('SELECT id, upper_right, lower_left FROM grid_cells;').fetchall()
+    conn.executemany('UPDATE grid_cells SET lat_min = ?, lon_min = ?, lat_max = ?, lon_max = ? WHERE id = ?;',
+                     [(*split(lower_left), *split(upper_right), cell_id) for cell_id, upper_right, lower_left in cells])
+
+
+def pack_boundaries(conn):
+    """
+    Moves the corners of the hexagons from the 'lat,lon;lat,lon;...' text of the column 'boundary' to the column
+    'corners', as the little-endian float64 (lat, lon) pairs read back with numpy.frombuffer().
+
+    Args:
+        conn (sqlite3.Connection): The connection to the db.
+
+    Returns:
+        None
+    """
+
+    def pack(boundary):
+        return numpy.array([corner.split(',') for corner in boundary.split(';')], dtype='<f8').tobytes()
+
+    cells = conn.execute('SELECT id, boundary FROM grid_cells WHERE boundary IS NOT NULL;').fetchall()
+    conn.executemany('UPDATE grid_cells SET corners = ?, boundary = NULL WHERE id = ?;',
+                     [(pack(boundary), cell_id) for cell_id, boundary in cells])
+
+
+# The statements of each version of the schema, applied in order to the dbs with a lower 'PRAGMA user_version'.
+# Each statement is either SQL or a function that takes the connection.
+# New versions must be appended at the end, the existing ones must never change.
+MIGRATIONS = [
+    # 1: tables added after the first schema and the indexes of the queries in data_api.py
+    [
+        """CREATE TABLE IF NOT EXISTS cells_weights (cell_id INTEGER PRIMARY KEY, weight REAL NOT NULL,
+            FOREIGN KEY(cell_id) REFERENCES grid_cells(id));""",
+        """CREATE TABLE IF NOT EXISTS cells_frequencies (id INTEGER PRIMARY KEY, stations_source TEXT NOT NULL, 
+            day TEXT NOT NULL, hour TEXT NOT NULL, cell_id INTEGER NOT NULL, bus_id INTEGER NOT NULL, 
+            count INTEGER NOT NULL, FOREIGN KEY(cell_id) REFERENCES grid_cells(id),
+            FOREIGN KEY(bus_id) REFERENCES buses(id));""",
+        # get_routes_geojson(): the points of the buses in order, without reading the table
+        """CREATE INDEX IF NOT EXISTS routes_points_bus 
+            ON routes_points (bus_id, segment, seq, coordinates);""",
+        # get_route_cells() and the duplicate check of generate-grid.py
+        'CREATE INDEX IF NOT EXISTS routes_cells_bus ON routes_cells (bus_id, seq, cell_id);',
+        # get_grid_geojson() for the partial hours of its time range
+        'CREATE INDEX IF NOT EXISTS departures_day_time ON departures (day, time, station_id, bus_id);',
+        # The count check of get-schedules.py
+        'CREATE INDEX IF NOT EXISTS departures_station ON departures (station_id, day);',
+        # The mapping of the departures to the cells
+        'CREATE INDEX IF NOT EXISTS stations_cells_overpass_station ON stations_cells_overpass (station_id, cell_id);',
+        'CREATE INDEX IF NOT EXISTS stations_cells_here_station ON stations_cells_here (station_id, cell_id);',
+        # get_grid_geojson() for the whole hours of its time range, for all the buses and for a subset of them
+        """CREATE INDEX IF NOT EXISTS cells_frequencies_hour 
+            ON cells_frequencies (stations_source, day, hour, cell_id, count);""",
+        """CREATE INDEX IF NOT EXISTS cells_frequencies_bus 
+            ON cells_frequencies (stations_source, bus_id, day, hour, cell_id, count);""",
+    ],
+    # 2: numeric coordinates next to the 'lat,lon' text, so that the geometries are read without parsing
+    [
+        'ALTER TABLE routes_points ADD COLUMN lat REAL;',
+        'ALTER TABLE routes_points ADD COLUMN lon REAL;',
+        'ALTER TABLE stations ADD COLUMN lat_overpass REAL;',
+        'ALTER TABLE stations ADD COLUMN lon_overpass REAL;',
+        'ALTER TABLE stations ADD COLUMN lat_here REAL;',
+        'ALTER TABLE stations ADD COLUMN lon_here REAL;',
+        'ALTER TABLE grid_cells ADD COLUMN lat_min REAL;',
+        'ALTER TABLE grid_cells ADD COLUMN lon_min REAL;',
+        'ALTER TABLE grid_cells ADD COLUMN lat_max REAL;',
+        'ALTER TABLE grid_cells ADD COLUMN lon_max REAL;',
+        split_coordinates,
+        # get_routes_geojson() reads the numeric coordinates instead of the text
+        'DROP INDEX IF EXISTS routes_points_bus;',
+        'CREATE INDEX IF NOT EXISTS routes_points_lat_lon ON routes_points (bus_id, segment, seq, lat, lon);',
+    ],
+    # 3: the routes simplified for each level of detail, see simplify-routes.py
+    [
+        'CREATE TABLE IF NOT EXISTS routes_lod_levels (level INTEGER PRIMARY KEY, tolerance REAL NOT NULL);',
+        """CREATE TABLE IF NOT EXISTS routes_points_lod (id INTEGER PRIMARY KEY, level INTEGER NOT NULL, 
+            bus_id INTEGER NOT NULL, segment INTEGER NOT NULL, seq INTEGER NOT NULL, lat REAL NOT NULL, 
+            lon REAL NOT NULL, FOREIGN KEY(level) REFERENCES routes_lod_levels(level),
+            FOREIGN KEY(bus_id) REFERENCES buses(id));""",
+        """CREATE INDEX IF NOT EXISTS routes_points_lod_bus 
+            ON routes_points_lod (level, bus_id, segment, seq, lat, lon);""",
+    ],
+    # 4: the resolution levels of the grid pyramid, see generate-grid.py, the existing grid becomes the level 0
+    [
+        'ALTER TABLE grid_cells ADD COLUMN level INTEGER NOT NULL DEFAULT 0;',
+        'ALTER TABLE routes_cells ADD COLUMN level INTEGER NOT NULL DEFAULT 0;',
+        'ALTER TABLE stations_cells_overpass ADD COLUMN level INTEGER NOT NULL DEFAULT 0;',
+        'ALTER TABLE stations_cells_here ADD COLUMN level INTEGER NOT NULL DEFAULT 0;',
+        'CREATE INDEX IF NOT EXISTS grid_cells_level ON grid_cells (level);',
+        # get_route_cells() for a single level
+        'DROP INDEX IF EXISTS routes_cells_bus;',
+        'CREATE INDEX IF NOT EXISTS routes_cells_level_bus ON routes_cells (level, bus_id, seq, cell_id);',
+        # The partial hours of get_buses_count() for a single level
+        'DROP INDEX IF EXISTS stations_cells_overpass_station;',
+        'DROP INDEX IF EXISTS stations_cells_here_station;',
+        'CREATE INDEX IF NOT EXISTS stations_cells_overpass_level ON stations_cells_overpass (station_id, level, cell_id);',
+        'CREATE INDEX IF NOT EXISTS stations_cells_here_level ON stations_cells_here (station_id, level, cell_id);',
+    ],
+    # 5: the corners of the cells that are not rectangles (the hexagons), see generate-grid.py
+    [
+        'ALTER TABLE grid_cells ADD COLUMN boundary TEXT;',
+    ],
+    # 6: the departures without a bus_id are aggregated too, so 'cells_frequencies' is rebuilt with a nullable bus_id
+    [
+        'DROP INDEX IF EXISTS cells_frequencies_hour;',
+        'DROP INDEX IF EXISTS cells_frequencies_bus;',
+        'ALTER TABLE cells_frequencies RENAME TO cells_frequencies_previous;',
+        """CREATE TABLE cells_frequencies (id INTEGER PRIMARY KEY, stations_source TEXT NOT NULL, 
+            day TEXT NOT NULL, hour TEXT NOT NULL, cell_id INTEGER NOT NULL, bus_id INTEGER, 
+            count INTEGER NOT NULL, FOREIGN KEY(cell_id) REFERENCES grid_cells(id),
+            FOREIGN KEY(bus_id) REFERENCES buses(id));""",
+        """INSERT INTO cells_frequencies (id, stations_source, day, hour, cell_id, bus_id, count) 
+            SELECT id, stations_source, day, hour, cell_id, bus_id, count FROM cells_frequencies_previous;""",
+        'DROP TABLE cells_frequencies_previous;',
+        """CREATE INDEX IF NOT EXISTS cells_frequencies_hour 
+            ON cells_frequencies (stations_source, day, hour, cell_id, count);""",
+        """CREATE INDEX IF NOT EXISTS cells_frequencies_bus 
+            ON cells_frequencies (stations_source, bus_id, day, hour, cell_id, count);""",
+    ],
+    # 7: the corners of the hexagons as packed numbers instead of text, 'boundary' is left empty
+    [
+        'ALTER TABLE grid_cells ADD COLUMN corners BLOB;',
+        pack_boundaries,
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate_db(conn):
+    """
+    Upgrades the schema of the db to SCHEMA_VERSION. Each version is applied in its own transaction together with
+    the update of 'PRAGMA user_version', so an interrupted upgrade can simply be run again.
+    The query planner statistics are refreshed with ANALYZE when at least one version is applied.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the db.
+
+    Returns:
+        tuple: The version of the db before and after the upgrade.
+    """
+
+    version = conn.execute('PRAGMA user_version;').fetchone()[0]
+
+    if version > SCHEMA_VERSION:
+        raise Exception('The db has a newer schema than the known migrations!')
+
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute('BEGIN;')
+        try:
+            for stmt in statements:
+                if callable(stmt):
+                    stmt(conn)
+                else:
+                    conn.execute(stmt)
+            conn.execute(f'PRAGMA user_version = {number};')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    if version < SCHEMA_VERSION:
+        conn.execute('ANALYZE;')
+        conn.commit()
+
+    return version, SCHEMA_VERSION
+
+
+if __name__ == '__main__':
+    conn = sqlite3.connect(db)
+    print('Schema version: %d -> %d' % migrate_db(conn))
+    conn.close()
@@ -0,0 +1,41 @@
+import sqlite3
+from pathlib import Path
+
+db = Path.cwd().parent / 'data/main.db'
+
+
+def refresh_frequencies():
+    """
+    Rebuilds the table 'cells_frequencies' with the number of departures of each bus in each grid cell
+    for every stations source, day type and hour. The departures are mapped to the cells through their stations
+    like in get_grid_geojson() of data_api.py, which reads the whole hours of its time range from this table
+    instead of scanning the table 'departures'. The departures without a bus_id are aggregated with a NULL bus_id,
+    so they are counted in the totals of all the buses like in the table 'departures'.
+    It must be run again after generate-grid.py or get-schedules.py change the underlying tables, which empty the
+    table, until then data_api.py counts the departures from the table 'departures'.
+    The table and its indexes are created by init-db.py or by migrations.py for existing dbs.
+
+    Returns:
+        None
+    """
+
+    conn = sqlite3.connect(db)
+    cursor = conn.cursor()
+
+    stmt_delete = 'DELETE FROM cells_frequencies;'
+    cursor.execute(stmt_delete)
+
+    for stations_source in ('overpass', 'here'):
+        stmt_insert = f"""INSERT INTO cells_frequencies (stations_source, day, hour, cell_id, bus_id, count)
+            SELECT ?, day, substr(time, 0, 3) AS interval, cell_id, bus_id, count(*) 
+            FROM departures d, stations_cells_{stations_source} sc WHERE d.station_id = sc.station_id 
+            GROUP BY day, interval, cell_id, bus_id;"""
+        cursor.execute(stmt_insert, (stations_source,))
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    refresh_frequencies()
@@ -0,0 +1,67 @@
+import itertools
+import sqlite3
+from pathlib import Path
+
+from shapely.geometry import LineString
+
+db = Path.cwd().parent / 'data/main.db'
+
+# Simplification tolerance in degrees of each level of detail, level 0 being the full resolution routes.
+# They are the size of a pixel of the 256 px map tiles at the zoom levels 17, 15, 13, 11 and 9,
+# see get_lod_level() in data_api.py.
+LOD_TOLERANCES = [360 / (256 * 2 ** zoom) for zoom in (17, 15, 13, 11, 9)]
+
+
+def simplify_routes(tolerances=LOD_TOLERANCES):
+    """
+    Simplifies the route of each bus with the Douglas-Peucker algorithm for every level of detail and saves
+    the points in the table 'routes_points_lod' and the tolerances in the table 'routes_lod_levels'.
+    get_routes_geojson() of data_api.py serves them to the zoomed out maps without simplifying on each request.
+    It must be run again after get-routes.py changes the table 'routes_points'.
+
+    Args:
+        tolerances (list of float, optional): The tolerance in degrees of each level, starting from level 1.
+        Defaults to LOD_TOLERANCES.
+
+    Returns:
+        None
+    """
+
+    conn = sqlite3.connect(db)
+    cursor = conn.cursor()
+
+    stmt_delete = 'DELETE FROM routes_points_lod;'
+    cursor.execute(stmt_delete)
+    stmt_delete = 'DELETE FROM routes_lod_levels;'
+    cursor.execute(stmt_delete)
+
+    stmt_points = 'SELECT bus_id, segment, lat, lon FROM routes_points ORDER BY bus_id, segment, seq;'
+    segments = [
+        (bus_id, segment, [point[2:] for point in points])
+        for (bus_id, segment), points in itertools.groupby(cursor.execute(stmt_points), key=lambda row: row[:2])
+    ]
+
+    stmt_level = 'INSERT INTO routes_lod_levels (level, tolerance) VALUES (?, ?);'
+    stmt_insert = 'INSERT INTO routes_points_lod (level, bus_id, segment, seq, lat, lon) VALUES (?, ?, ?, ?, ?, ?);'
+
+    points_amount = sum(len(points) for _, _, points in segments)
+
+    for level, tolerance in enumerate(tolerances, start=1):
+        cursor.execute(stmt_level, (level, tolerance))
+
+        data = []
+        for bus_id, segment, points in segments:
+            if len(points) > 2:
+                points = LineString(points).simplify(tolerance, preserve_topology=False).coords
+            data += [(level, bus_id, segment, seq, lat, lon) for seq, (lat, lon) in enumerate(points, start=1)]
+
+        cursor.executemany(stmt_insert, data)
+        print(f'Level {level} (tolerance {tolerance}): {len(data)}/{points_amount} points')
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    simplify_routes()